@@ -2,15 +2,25 @@ import random
 import logging
 import asyncio
 import json
+import time
+from contextlib import asynccontextmanager
 from functools import wraps
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Literal, Optional
 
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 
 from .ask_terminal import AskTerminal, ChatQueryEnvModel
+from .completion_cache import CompletionCache
+from .conversation_lock import ConversationLocks, ConversationBusyError
+from .conversation_pool import ConversationPool
+from .conversation_store import ConversationStore
+from .endpoint_registry import endpoint_registry
+from .libs.broadcast import Broadcast
+from .libs.head_tail_buffer import HeadTailBuffer
+from .libs.text_completion_endpoint import client_session_pool
 from .settings import Settings
 
 _logger = logging.getLogger(__name__)
@@ -35,14 +45,129 @@ class ChatQueryReplyModel(ChatQueryModel):
   command_executed: bool
 
 
-app = FastAPI()
+CHAT_POOL_SWEEP_INTERVAL = 60
 
 settings = Settings()
-chat_pool: Dict[str, AskTerminal] = {}
+chat_locks = ConversationLocks(
+  max_queued=settings.conversation_pool.max_queued_requests,
+  timeout=settings.conversation_pool.queue_timeout,
+)
+chat_pool = ConversationPool.from_settings(settings.conversation_pool, in_use=chat_locks.in_use)
+chat_store: Optional[ConversationStore] = None
+completion_cache: Optional[CompletionCache] = None
+inflight_requests: Dict[tuple, Broadcast] = {}
+num_coalesced_requests = 0
 
 def set_settings(_settings: Settings):
-  global settings
+  global settings, chat_pool, chat_locks
   settings = _settings
+  chat_locks = ConversationLocks(
+    max_queued=settings.conversation_pool.max_queued_requests,
+    timeout=settings.conversation_pool.queue_timeout,
+  )
+  chat_pool = ConversationPool.from_settings(settings.conversation_pool, in_use=chat_locks.in_use)
+
+def create_chat(conversation_id: str, init_cfg: ChatInitModel):
+  chat_settings = settings.model_copy(deep=True)
+  for prop in init_cfg.model_fields_set:
+    setattr(chat_settings.ask_terminal, prop, getattr(init_cfg, prop))
+
+  return AskTerminal(chat_settings, conversation_id=conversation_id, history_store=chat_store, completion_cache=completion_cache)
+
+async def get_chat(conversation_id: str) -> Optional[AskTerminal]:
+  """
+  Get a conversation from the pool. With a conversation store, it is rehydrated from the store
+  if it is not in memory, or reloaded if another server process has updated it since.
+  Should be called while holding the lock of the conversation.
+  """
+  conversation = chat_pool.get(conversation_id)
+  if chat_store is None:
+    return conversation
+
+  if conversation is not None:
+    version = await chat_store.version(conversation_id)
+    if version == conversation.history_version:
+      return conversation
+
+  stored = await chat_store.load(conversation_id)
+  if stored is None:
+    chat_pool.remove(conversation_id)  # deleted by another server process
+    return None
+
+  init_cfg, items, version = stored
+  if conversation is None:
+    conversation = create_chat(conversation_id, ChatInitModel(**init_cfg))
+    conversation.restore_history(items, version=version)
+    chat_pool.add(conversation_id, conversation)
+  else:
+    conversation.restore_history(items, version=version)
+    chat_pool.update(conversation_id)
+  _logger.debug(f"Loaded conversation '{conversation_id}' with {len(items)} items (version {version})")
+
+  return conversation
+
+def hold_conversation_lock(func):
+  @wraps(func)
+  async def wrapper(conversation_id: str, *args, **kwargs):
+    try:
+      async with chat_locks.hold(conversation_id, chat_store):
+        return await func(conversation_id, *args, **kwargs)
+    except ConversationBusyError as e:
+      _logger.warning(str(e))
+      return {
+        "status": "error",
+        "error": "Conversation is busy, please try again later",
+      }
+
+  return wrapper
+
+async def sweep_chat_pool():
+  while True:
+    await asyncio.sleep(CHAT_POOL_SWEEP_INTERVAL)
+    chat_pool.evict_expired()
+    if chat_store is not None:
+      try:
+        await chat_store.purge(settings.conversation_store.retention)
+      except Exception as e:
+        _logger.warning(f"Failed to purge stored conversations: {e}")
+
+async def warm_up_default_endpoint():
+  endpoint = settings.ask_terminal.endpoint
+  if endpoint not in settings.text_completion_endpoints:
+    return
+
+  try:
+    await endpoint_registry.warm_up(
+      endpoint,
+      settings.text_completion_endpoints[endpoint],
+      model_name=settings.ask_terminal.model_name,
+    )
+  except Exception as e:
+    _logger.warning(f"Failed to warm up endpoint '{endpoint}': {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  global chat_store, completion_cache
+  chat_store = ConversationStore.from_settings(settings.conversation_store)
+  completion_cache = CompletionCache.from_settings(settings.completion_cache)
+  client_session_pool.open(settings.text_completion_endpoints)
+  sweep_task = asyncio.create_task(sweep_chat_pool())
+  warm_up_task = asyncio.create_task(warm_up_default_endpoint())
+  try:
+    yield
+  finally:
+    warm_up_task.cancel()
+    sweep_task.cancel()
+    endpoint_registry.close()
+    await client_session_pool.close()
+    if chat_store is not None:
+      await chat_store.close()
+      chat_store = None
+    if completion_cache is not None:
+      completion_cache.close()
+      completion_cache = None
+
+app = FastAPI(lifespan=lifespan)
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
@@ -67,90 +192,206 @@ async def request_validation_exception_handler(request, exc):
   )
 
 @app.post('/chat/{conversation_id}/init')
+@hold_conversation_lock
 async def init(conversation_id: str, init_cfg: ChatInitModel=ChatInitModel()):
-  if conversation_id in chat_pool:
+  if await get_chat(conversation_id) is not None:
     return {
       "status": "error",
       "error": "Conversation already exists",
     }
 
-  chat_settings = settings.model_copy(deep=True)
-  for prop in init_cfg.model_fields_set:
-    setattr(chat_settings.ask_terminal, prop, getattr(init_cfg, prop))
-
   try:
-    chat_pool[conversation_id] = AskTerminal(chat_settings)
+    conversation = create_chat(conversation_id, init_cfg)
   except ValueError as e:
     return {
       "status": "error",
       "error": str(e),
     }
 
+  if chat_store is not None and not await chat_store.create(conversation_id, init_cfg.model_dump(exclude_unset=True)):
+    return {
+      "status": "error",
+      "error": "Conversation already exists",
+    }
+
+  chat_pool.add(conversation_id, conversation)
+
   return {
     "status": "success",
   }
 
-def conditional_query_streaming_response(num_sections=1):
-  def decorator(func):
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-      stream = False
-      if 'query' in kwargs:
-        query: ChatQueryModel = kwargs.get('query')
-        stream = query.stream
+@app.delete('/chat/{conversation_id}')
+@hold_conversation_lock
+async def delete(conversation_id: str):
+  removed = chat_pool.remove(conversation_id)
+  if chat_store is not None:
+    removed = await chat_store.delete(conversation_id)  # the copy in the pool may be stale
+
+  if not removed:
+    return {
+      "status": "error",
+      "error": "Conversation does not exist",
+    }
 
-      q_response = asyncio.Queue()
+  return {
+    "status": "success",
+  }
 
+@app.get('/stats')
+async def stats():
+  return {
+    "status": "success",
+    "payload": {
+      "conversation_pool": chat_pool.stats(),
+      "requests": {
+        "in_flight": len(inflight_requests),
+        "coalesced": num_coalesced_requests,
+      },
+      "completion_cache": completion_cache.stats() if completion_cache is not None else None,
+      "endpoints": endpoint_registry.stats(),
+    },
+  }
+
+class StreamFrames:
+  """
+  Coalesce the streamed tokens of a section into NDJSON frames. The pending tokens are sent
+  once they reach `flush_bytes` characters, `flush_interval` seconds after the first of them,
+  or at the end of the section, whichever comes first.
+  """
+
+  def __init__(self, flush_bytes=0, flush_interval=0):
+    self.flush_bytes = flush_bytes
+    self.flush_interval = flush_interval
+
+    self._section = None
+    self._parts: List[str] = []
+    self._size = 0
+    self._since = None
+
+  def add(self, section, content, stop) -> List[str]:
+    """
+    Returns the frames ready to be sent.
+    """
+    frames = []
+    if self._since is not None and section != self._section:
+      frames.append(self.flush())
+
+    self._section = section
+    if content:
+      self._parts.append(content)
+      self._size += len(content)
+    if self._since is None:
+      self._since = time.monotonic()
+
+    if stop or self._size >= self.flush_bytes:
+      frames.append(self.flush(finished=stop))
+
+    return frames
+
+  def due_in(self) -> Optional[float]:
+    """
+    Seconds until the pending tokens are due, or None if there are none.
+    """
+    if self._since is None:
+      return None
+    return self._since + self.flush_interval - time.monotonic()
+
+  def flush(self, finished=False) -> str:
+    frame = json.dumps({
+      'section': self._section,
+      'content': ''.join(self._parts),
+      'finished': finished,
+    }, ensure_ascii=False)
+
+    self._parts = []
+    self._size = 0
+    self._since = None
+
+    return frame + '\n'
+
+def conditional_query_streaming_response(func):
+  """
+  Stream the sections of the reply if the query asks for it.
+  A request identical to one still in flight on the same conversation, e.g. a retry from
+  the client, is coalesced onto it: it shares its generation and result instead of querying
+  the upstream endpoint again.
+  """
+  @wraps(func)
+  async def wrapper(conversation_id: str, query: ChatQueryModel, **kwargs):
+    global num_coalesced_requests
+
+    key = (func.__name__, conversation_id, query.model_dump_json())
+    broadcast = inflight_requests.get(key)
+    if broadcast is None or broadcast.done():
       async def receive_response(content, stop, res, section):
-        await q_response.put((section, content, stop))
-
-      async def stream_response(producer_task: asyncio.Task):
-        sections_left = num_sections
-        while True:
-          get_response_task = asyncio.create_task(q_response.get())
-          done, pending = await asyncio.wait([producer_task, get_response_task], return_when=asyncio.FIRST_COMPLETED)
-          if get_response_task in done:
-            section, content, stop = get_response_task.result()
-          else:
-            get_response_task.cancel()
-            break  # stop early on error
-
-          s_res = json.dumps({
-            'section': section,
-            'content': content if content is not None else '',
-            'finished': stop,
-          }, ensure_ascii=False)
-          yield s_res + '\n'
-          if stop:
-            sections_left -= 1
-            if sections_left == 0:
-              break
-
-        final_response = await producer_task
-        final_response = json.dumps(final_response, ensure_ascii=False)
-        yield final_response + '\n'
-
-      kwargs['streaming_cb'] = receive_response if stream else None
-      producer_task = asyncio.create_task(func(*args, **kwargs))
-
-      if not stream:
-        return await producer_task
-      else:
-        return StreamingResponse(stream_response(producer_task), media_type="text/plain")
-
-    return wrapper
-
-  return decorator
+        broadcast.publish((section, content, stop))
+
+      kwargs['streaming_cb'] = receive_response if query.stream else None
+      broadcast = Broadcast(func(conversation_id=conversation_id, query=query, **kwargs))
+      inflight_requests[key] = broadcast
+
+      def forget_request(_):
+        if inflight_requests.get(key) is broadcast:
+          del inflight_requests[key]
+      broadcast.task.add_done_callback(forget_request)
+    else:
+      num_coalesced_requests += 1
+      _logger.debug(f"Coalesced duplicated request '{func.__name__}' on conversation '{conversation_id}'")
+
+    if not query.stream:
+      return await broadcast.result()
+
+    async def stream_response():
+      frames = StreamFrames(
+        flush_bytes=settings.streaming.flush_bytes,
+        flush_interval=settings.streaming.flush_interval,
+      )
+      loop = asyncio.get_running_loop()
+      timer = None
+      timer_due = None  # uvloop's handles do not tell when they are due
+
+      # the generation is cancelled when the last client streaming it disconnects
+      batches = broadcast.subscribe()
+      try:
+        async for batch in batches:
+          for section, content, stop in batch:
+            for frame in frames.add(section, content, stop):
+              yield frame
+
+          due_in = frames.due_in()
+          if due_in is None:
+            continue
+          if due_in <= 0:
+            yield frames.flush()
+          elif timer_due is None or timer_due <= loop.time():  # no timer pending
+            timer = loop.call_later(due_in, broadcast.wake)
+            timer_due = loop.time() + due_in
+
+        if frames.due_in() is not None:  # the generation has failed midway
+          yield frames.flush()
+      finally:
+        if timer is not None:
+          timer.cancel()
+        await batches.aclose()
+
+      final_response = await broadcast.result()
+      final_response = json.dumps(final_response, ensure_ascii=False)
+      yield final_response + '\n'
+
+    return StreamingResponse(stream_response(), media_type="text/plain")
+
+  return wrapper
 
 @app.post('/chat/{conversation_id}/query_command')
-@conditional_query_streaming_response(num_sections=2)
+@conditional_query_streaming_response
+@hold_conversation_lock
 async def query_command(conversation_id: str, query: ChatQueryCommandModel, streaming_cb=None):
-  if conversation_id not in chat_pool:
+  conversation = await get_chat(conversation_id)
+  if conversation is None:
     return {
       "status": "error",
       "error": "Conversation does not exist",
     }
-  conversation = chat_pool[conversation_id]
 
   try:
     response = await conversation.query_command(
@@ -165,6 +406,8 @@ async def query_command(conversation_id: str, query: ChatQueryCommandModel, stre
       "status": "error",
       "error": "Failed to communicate with upstream endpoint"
     }
+  finally:
+    chat_pool.update(conversation_id)
 
   return {
       "status": "success",
@@ -172,14 +415,15 @@ async def query_command(conversation_id: str, query: ChatQueryCommandModel, stre
     }
 
 @app.post('/chat/{conversation_id}/query_reply')
-@conditional_query_streaming_response()
+@conditional_query_streaming_response
+@hold_conversation_lock
 async def query_reply(conversation_id: str, query: ChatQueryReplyModel, streaming_cb=None):
-  if conversation_id not in chat_pool:
+  conversation = await get_chat(conversation_id)
+  if conversation is None:
     return {
       "status": "error",
       "error": "Conversation does not exist",
     }
-  conversation = chat_pool[conversation_id]
 
   try:
     response = await conversation.query_reply(
@@ -195,10 +439,159 @@ async def query_reply(conversation_id: str, query: ChatQueryReplyModel, streamin
       "status": "error",
       "error": "Failed to communicate with upstream endpoint"
     }
+  finally:
+    chat_pool.update(conversation_id)
 
   return {
       "status": "success",
       "payload": response,
     }
 
-
+async def receive_observation(chunks: AsyncIterator[bytes]) -> str:
+  """
+  Receive the output of a command, keeping only its beginning and its end.
+  """
+  max_bytes = settings.ask_terminal.max_observation_bytes
+  head_size = int(max_bytes*AskTerminal.TRUNCATION_FRONT_RATIO)
+  observation = HeadTailBuffer(head_size, max_bytes - head_size)
+  async for chunk in chunks:
+    observation.feed(chunk)
+
+  if observation.num_dropped > 0:
+    _logger.debug(f"Kept {max_bytes} of the {observation.num_bytes} bytes of the observation")
+
+  return observation.getvalue(AskTerminal.TRUNCATION_INDICATOR)
+
+@app.post('/chat/{conversation_id}/query_reply_raw')
+async def query_reply_raw(
+    conversation_id: str, request: Request,
+    command_executed: bool, stream: bool=False, os: str="Unix", shell: Optional[Literal["bash", "zsh"]]=None,
+  ):
+  """
+  Same as `query_reply`, but with the output of the command as the raw body of the request,
+  and the other fields as query parameters. Only the beginning and the end of the output are
+  kept while it is received, so the output of a command can be uploaded as is, however long.
+  """
+  query = ChatQueryReplyModel(
+    message=await receive_observation(request.stream()),
+    stream=stream,
+    env=ChatQueryEnvModel(os=os, shell=shell),
+    command_executed=command_executed,
+  )
+  return await query_reply(conversation_id, query)
+
+class WebSocketRequests:
+  """
+  Receive the requests of a conversation over a WebSocket. A message can be received in the
+  background while a request is served, so that the client can cancel it.
+  """
+
+  def __init__(self, websocket: WebSocket):
+    self._websocket = websocket
+    self._next_message: Optional[asyncio.Task] = None
+
+  def next_message(self) -> asyncio.Task:
+    if self._next_message is None:
+      self._next_message = asyncio.create_task(self._websocket.receive())
+    return self._next_message
+
+  async def receive(self, kind='text'):
+    message = await self.next_message()
+    self._next_message = None
+
+    if message['type'] == 'websocket.disconnect':
+      raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+    if message.get(kind) is None:
+      raise ValueError(f"Expected a {kind} message")
+    return message[kind]
+
+  async def observation_chunks(self):
+    while True:
+      chunk = await self.receive('bytes')
+      if len(chunk) == 0:
+        break
+      yield chunk
+
+  def close(self):
+    if self._next_message is not None:
+      self._next_message.cancel()
+
+async def serve_websocket_request(websocket: WebSocket, conversation_id: str, request_type: str, request: Dict):
+  if request_type == 'init':
+    response = await init(conversation_id, ChatInitModel(**request))
+  elif request_type == 'delete':
+    response = await delete(conversation_id)
+  elif request_type == 'query_command':
+    response = await query_command(conversation_id, ChatQueryCommandModel(**request))
+  elif request_type == 'query_reply':
+    response = await query_reply(conversation_id, ChatQueryReplyModel(**request))
+  else:
+    raise ValueError(f"Invalid request type '{request_type}'")
+
+  if not isinstance(response, StreamingResponse):
+    await websocket.send_text(json.dumps(response, ensure_ascii=False))
+    return
+
+  lines = response.body_iterator
+  try:
+    async for line in lines:
+      await websocket.send_text(line.rstrip('\n'))
+  finally:
+    await lines.aclose()
+
+@app.websocket('/chat/{conversation_id}/ws')
+async def chat_websocket(websocket: WebSocket, conversation_id: str):
+  """
+  Carry the requests of a conversation over one connection. Each request is a JSON text message
+  with its `type` (`init`, `delete`, `query_command`, `query_reply` or `query_reply_raw`) and the
+  fields of the HTTP request of that name, and is answered with the lines of the HTTP response
+  as text messages, the last of which has the `status` of the request.
+  `query_reply_raw` is followed by the output of the command in binary messages, ended by an empty one.
+  Any message received while a request is served cancels it, e.g. `{"type": "cancel"}`.
+  """
+  await websocket.accept()
+  requests = WebSocketRequests(websocket)
+  try:
+    while True:
+      try:
+        request = json.loads(await requests.receive())
+        if not isinstance(request, dict):
+          raise ValueError("Expected a JSON object")
+        request_type = request.pop('type', None)
+        if request_type == 'cancel':
+          continue  # the request has already been served
+        if request_type == 'query_reply_raw':
+          request_type = 'query_reply'
+          request['message'] = await receive_observation(requests.observation_chunks())
+      except ValueError as e:
+        _logger.error(f"Bad WebSocket request: {e}")
+        await websocket.send_text(json.dumps({ "status": "error", "error": "Bad request" }))
+        continue
+
+      serving = asyncio.create_task(serve_websocket_request(websocket, conversation_id, request_type, request))
+      cancelling = requests.next_message()
+      await asyncio.wait([serving, cancelling], return_when=asyncio.FIRST_COMPLETED)
+      if not serving.done():
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+        if cancelling.result()['type'] == 'websocket.disconnect':
+          break
+        await requests.receive()  # consume the cancelling message
+        _logger.debug(f"Request '{request_type}' on conversation '{conversation_id}' cancelled by the client")
+        await websocket.send_text(json.dumps({ "status": "error", "error": "Request cancelled" }))
+        continue
+
+      try:
+        serving.result()
+      except ValueError as e:  # including validation errors
+        _logger.error(f"Bad WebSocket request: {e}")
+        await websocket.send_text(json.dumps({ "status": "error", "error": "Bad request" }))
+      except WebSocketDisconnect:
+        raise
+      except Exception as e:
+        _logger.error("Error occurred", exc_info=e)
+        await websocket.send_text(json.dumps({ "status": "error", "error": "Something went wrong. Please try again." }))
+  except WebSocketDisconnect:
+    pass
+  finally:
+    requests.close()
@@ -1,16 +1,21 @@
 import logging
 import os
 import math
+import sys
+import uuid
 from functools import wraps
 import asyncio
-from typing import List, Literal, Optional, Union, Coroutine, Any
+from typing import Dict, List, Literal, Optional, Union, Coroutine, Any
 
-import yaml
 from mext import Mext
 from pydantic import BaseModel
 
-from .libs.text_completion_endpoint import LLamaTextCompletion, OpenAITextCompletion, AnthropicTextCompletion, OllamaTextCompletion
-from .utils import search_config_file, LOG_HEAVY
+from .completion_cache import CompletionCache
+from .conversation_store import ConversationStore
+from .endpoint_registry import EndpointRegistry, endpoint_registry
+from .libs.incremental_composer import IncrementalComposer
+from .libs.section_splitter import SectionSplitter
+from .utils import auto_async, search_config_file, LOG_HEAVY
 from .settings import Settings
 
 
@@ -36,10 +41,26 @@ class AskTerminal:
   TRUNCATION_FRONT_RATIO = 0.3
   TRUNCATION_COARSE_GAP = 16
 
-  def __init__(self, settings: Settings):
+  def __init__(
+      self, settings: Settings, conversation_id: Optional[str]=None,
+      history_store: Optional[ConversationStore]=None, completion_cache: Optional[CompletionCache]=None,
+    ):
+    """
+    Params
+    ======
+    history_store:
+      if provided, every update to an item of the history is written to the store
+    completion_cache:
+      if provided, the thinking and the command of the first query are looked up in and saved to the cache
+    """
     self._logger = _logger
     self._logger.debug(str(settings))
 
+    self._conversation_id = conversation_id or uuid.uuid4().hex
+    self._history_store = history_store
+    self._completion_cache = completion_cache
+    self.history_version = 0  # version of the history in the store
+
     self._configs = settings.ask_terminal
     self._user = self._configs.user
     self._agent = self._configs.agent
@@ -50,6 +71,7 @@ class AskTerminal:
       raise ValueError(f"Invalid endpoint '{self._tc_endpoint}'")
     self._tc_cfg = text_completion_endpoints[self._tc_endpoint]
     self._tc_params = self._tc_cfg.get('params', {})
+    self._max_prompt_tokens = self._tc_cfg.get('max_prompt_tokens', self._configs.max_prompt_tokens)
 
     self._initialize_endpoint()
 
@@ -72,65 +94,139 @@ class AskTerminal:
       shell="bash",  # default using bash
       use_thinking=self._configs.use_thinking,
     )
+    self._composer = IncrementalComposer(self._context_mgr)
     self._history: List[ChatHistoryItem] = []
+    self._history_start = 0  # the turns before are dropped from the prompt
+    self._compacted_items: Dict[int, ChatHistoryItem] = {}  # index -> item with its observation truncated harder
+    self._prefill_task: Optional[asyncio.Task] = None
 
   def _initialize_endpoint(self):
-    tc_logger = logging.getLogger('text-completion')
-    self._tc_logger = tc_logger
+    self._tc_logger = logging.getLogger('text-completion')
+    self._tc = endpoint_registry.get(
+      self._tc_endpoint,
+      self._tc_cfg,
+      model_name=self._configs.model_name,
+    )
 
-    def load_api_key():
-      api_key = None
-      creds_file = self._tc_cfg.get('credentials', None)
+    self._logger.info(f"Using endpoint '{self._tc_endpoint}' for text completion")
 
-      if creds_file:
-        creds_path = search_config_file(creds_file)
-        with open(creds_path, 'r') as f:
-          creds = yaml.safe_load(f)
-          api_key = creds.get('api_key', None)
+  def close(self):
+    if self._prefill_task is not None:
+      self._prefill_task.cancel()
+    self._tc.release_conversation(self._conversation_id)
+
+  def estimate_memory(self):
+    """
+    Estimated memory held by the history of the conversation, its compacted items
+    and the rendered items cached by the composer, in bytes.
+    """
+    # a compacted item is the item itself when it did not need truncating
+    items = { id(item): item for item in [*self._history, *self._compacted_items.values()] }.values()
+    return self._composer.estimate_memory() + sum(
+      sys.getsizeof(item) + sum(sys.getsizeof(value) for value in item.__dict__.values())
+      for item in items
+    )
 
-      return api_key
+  def restore_history(self, items: List[dict], version=0):
+    self._history = [ChatHistoryItem(**item) for item in items]
+    self.history_version = version
+    self._history_start = 0
+    self._compacted_items = {}
 
-    model_name = self._configs.model_name or self._tc_cfg.get('model', None)
+  async def _save_history_item(self, index=-1):
+    if self._history_store is None or len(self._history) == 0:
+      return
 
-    if self._tc_endpoint == 'ollama':
-      self._tc = OllamaTextCompletion(
-        server_url=self._tc_cfg['server_url'],
-        model_name=model_name,
-        logger=tc_logger,
-      )
-    elif self._tc_endpoint == 'local-llama':
-      self._tc = LLamaTextCompletion(
-        server_url=self._tc_cfg['server_url'],
-        logger=tc_logger,
-      )
-    elif self._tc_endpoint == 'openai':
-      api_key = load_api_key()
-      self._tc = OpenAITextCompletion(
-        model_name=model_name,
-        api_key=api_key,
-        logger=tc_logger,
-      )
-    elif self._tc_endpoint == 'anthropic':
-      api_key = load_api_key()
-      self._tc = AnthropicTextCompletion(
-        model_name=model_name,
-        api_key=api_key,
-        logger=tc_logger,
-        initial_system_msg=self._tc_cfg.get('initial_system_msg', None),
-      )
-    else:
-      raise ValueError(f"Invalid endpoint '{self._tc_endpoint}'")
-
-    self._logger.info(f"Using endpoint '{self._tc_endpoint}' for text completion")
+    index %= len(self._history)
+    self.history_version = await self._history_store.save_item(self._conversation_id, index, self._history[index].model_dump())
 
   def _get_stop_from_role(self, role: str):
     return self._roles_hint
 
-  async def chat(self, gen_role, stop=[], additional_params={}, cb=None):
-    prompt = self._context_mgr.compose(
+  def _prompt_history(self):
+    return [
+      self._compacted_items.get(index, self._history[index])
+      for index in range(self._history_start, len(self._history))
+    ]
+
+  async def _compose_parts(self, gen_role):
+    parts = self._composer.compose_parts(
       gen_role=gen_role,
-      history=self._history,
+      history=self._prompt_history(),
+    )
+    # the parts split at item boundaries, so the sum of their (cached) counts is a close estimate
+    num_tokens = 0
+    for part in parts:
+      num_tokens += await self._tc.num_tokens(part)
+    return parts, num_tokens
+
+  async def _compose(self, gen_role):
+    """
+    Compose the prompt over the history, compacting the history first if the prompt exceeds
+    the token budget. Returns the prompt and its estimated number of tokens, if counted.
+    """
+    budget = self._max_prompt_tokens
+    if budget <= 0:
+      # counting costs a request to the endpoint per part with most backends
+      return self._composer.compose(gen_role=gen_role, history=self._prompt_history()), None
+
+    parts, num_tokens = await self._compose_parts(gen_role)
+    if math.isinf(num_tokens):
+      self._logger.warning("Failed to count the tokens of the prompt, the history is not compacted")
+      return ''.join(parts), None
+
+    if num_tokens > budget:
+      parts, num_tokens = await self._compact_history(gen_role, budget)
+
+    self._logger.debug(f"Prompt of '{gen_role}': {num_tokens} tokens (budget: {budget})")
+    return ''.join(parts), num_tokens
+
+  async def _compact_history(self, gen_role, budget):
+    """
+    Truncate the observations of the previous turns to `max_history_observation_tokens`, then drop the
+    oldest turns until the prompt is within `compaction_ratio` of the budget. The last turn is always kept.
+    Compacting changes the prompt from the first compacted turn on, so it is done all at once, and with
+    room to spare, to keep the prefix of the prompt stable, and reusable by the endpoint, for a few turns.
+    """
+    for index in range(self._history_start, len(self._history) - 1):
+      if index not in self._compacted_items:
+        self._compacted_items[index] = await self._compact_history_item(self._history[index])
+
+    target = int(budget * self._configs.compaction_ratio)
+    parts, num_tokens = await self._compose_parts(gen_role)
+    while num_tokens > target and self._history_start < len(self._history) - 1:
+      self._compacted_items.pop(self._history_start, None)
+      self._history_start += 1
+      parts, num_tokens = await self._compose_parts(gen_role)
+
+    self._logger.info(f"Compacted the history to {len(self._history) - self._history_start} turns, {num_tokens} tokens")
+    if num_tokens > budget:
+      self._logger.warning(f"Prompt of '{gen_role}' exceeds the budget of {budget} tokens with only the last turn")
+
+    return parts, num_tokens
+
+  async def _compact_history_item(self, item: ChatHistoryItem):
+    observation = await self._tc.truncate(
+      item.observation,
+      self._configs.max_history_observation_tokens,
+      truncation_indicator=AskTerminal.TRUNCATION_INDICATOR,
+      front_ratio=AskTerminal.TRUNCATION_FRONT_RATIO,
+      coarse_gap=AskTerminal.TRUNCATION_COARSE_GAP,
     )
+    if observation == item.observation:
+      return item
+    return item.model_copy(update={ 'observation': observation })
+
+  async def chat(self, gen_role, stop=[], additional_params={}, cb=None, into: Optional[str]=None, cacheable=False):
+    """
+    Params
+    ======
+    into:
+      field of the last history item the partial reply is written to, if the generation is cancelled
+    cacheable:
+      look up the reply in the completion cache, and save it there
+    """
+    prompt, _ = await self._compose(gen_role)
     params = {
       **self._tc_params,
       **additional_params,
@@ -139,7 +235,36 @@ class AskTerminal:
 
     _logger.log(LOG_HEAVY, f"Prompt:\n{prompt}")
 
-    reply = await self._tc.create(prompt=prompt, params=params, cb=cb)
+    cb = auto_async(cb)
+
+    cache_key = None
+    if cacheable and self._completion_cache is not None:
+      cache_key = CompletionCache.make_key(self._tc_endpoint, self._configs.model_name or self._tc_cfg.get('model'), params, prompt)
+      reply = await self._completion_cache.get(cache_key)
+      if reply is not None:
+        _logger.debug(f"Reply of '{gen_role}' served from the completion cache")
+        if cb is not None:
+          await cb(content=reply, stop=False, res=None)
+          await cb(content='', stop=True, res=None)
+        return reply.strip()
+
+    chunks = []
+
+    async def collect_reply(content, **kwargs):
+      chunks.append(content or '')
+      if cb is not None:
+        await cb(content=content, **kwargs)
+
+    try:
+      reply = await self._tc.create(prompt=prompt, params=params, cb=collect_reply, conversation_id=self._conversation_id)
+    except asyncio.CancelledError:
+      self._logger.info(f"Generation of '{gen_role}' cancelled after {len(chunks)} chunks")
+      if into is not None:
+        setattr(self._history[-1], into, ''.join(chunks).strip())
+      raise
+
+    if cache_key is not None and reply.strip():
+      await self._completion_cache.put(cache_key, reply)
     reply = reply.strip()
 
     _logger.log(LOG_HEAVY, f"Response:\n{reply}")
@@ -156,6 +281,58 @@ class AskTerminal:
       return cb(*args, **kwargs, section=section_name)
     return wrapper
 
+  async def _chat_thinking_and_command(self, additional_params={}, cb=None):
+    """
+    Generate the thinking and the command in one completion, split at the role marker of the command.
+    Returns None for the command if the completion stops before reaching it.
+    """
+    gen_role = f"{self._agent}/Thinking"
+    marker = "%role%[Command]:"
+    splitter = SectionSplitter(
+      marker,
+      first_cb=AskTerminal._add_section_info_to_query_callback(cb, "thinking"),
+      second_cb=AskTerminal._add_section_info_to_query_callback(cb, "command"),
+    )
+
+    try:
+      reply = await self.chat(
+        gen_role=gen_role,
+        # stop at any role but the command, and at the fence of a block, e.g. an observation made up by the model
+        stop=[f"%role%[{role}]" for role in self._roles if role != "Command"] + ['~~~'],
+        additional_params=additional_params,
+        cb=splitter,
+        cacheable=len(self._history) == 1,
+      )
+    except asyncio.CancelledError:
+      self._history[-1].thinking = splitter.sections[0].strip()
+      self._history[-1].command = splitter.sections[1].strip()
+      raise
+
+    thinking, found, command = reply.partition(marker)
+    return thinking.strip(), command.strip() if found else None
+
+  async def _start_prefill(self, env):
+    """
+    Have the endpoint process the prompt of the reply up to the observation in the background,
+    while the command is being executed. The prompt is composed, and the history compacted, as
+    for the reply, so that it is a prefix of the prompt of the reply.
+    """
+    if not self._configs.speculative_prefill or not self._tc.supports_prefill:
+      return
+
+    with self._context_mgr.use_params(env=env):
+      prompt, _ = await self._compose("Observation")
+
+    async def prefill():
+      try:
+        await self._tc.prefill(prompt, conversation_id=self._conversation_id)
+      except Exception as e:
+        self._logger.debug(f"Failed to prefill the prompt of the reply: {e}")
+
+    if self._prefill_task is not None:
+      self._prefill_task.cancel()
+    self._prefill_task = asyncio.create_task(prefill())
+
   async def query_command(self, query, env: ChatQueryEnvModel={}, stream=False, cb=None):
     self._history.append(
       ChatHistoryItem(query=query),
@@ -165,27 +342,44 @@ class AskTerminal:
       'stream': stream,
     }
 
-    with self._context_mgr.use_params(env=env):
-      thinking = ""
-      if self._configs.use_thinking:
-        gen_role = f"{self._agent}/Thinking"
-        thinking = await self.chat(
-          gen_role=gen_role,
-          stop=self._get_stop_from_role(gen_role),
-          additional_params=additional_params,
-          cb=AskTerminal._add_section_info_to_query_callback(cb, "thinking"),
-        )
-        self._history[-1].thinking = thinking
-
-      gen_role = "Command"
-      command = await self.chat(
-        gen_role=gen_role,
-        stop=self._get_stop_from_role(gen_role),
-        additional_params=additional_params,
-        cb=AskTerminal._add_section_info_to_query_callback(cb, "command"),
-      )
-      command = command.strip('`')
-      self._history[-1].command = command
+    try:
+      with self._context_mgr.use_params(env=env):
+        thinking = ""
+        command = None
+        if self._configs.use_thinking and self._configs.combine_thinking_and_command:
+          thinking, command = await self._chat_thinking_and_command(
+            additional_params=additional_params,
+            cb=cb,
+          )
+          self._history[-1].thinking = thinking
+        elif self._configs.use_thinking:
+          gen_role = f"{self._agent}/Thinking"
+          thinking = await self.chat(
+            gen_role=gen_role,
+            stop=self._get_stop_from_role(gen_role),
+            additional_params=additional_params,
+            cb=AskTerminal._add_section_info_to_query_callback(cb, "thinking"),
+            into="thinking",
+            cacheable=len(self._history) == 1,
+          )
+          self._history[-1].thinking = thinking
+
+        if command is None:  # not generated along with the thinking
+          gen_role = "Command"
+          command = await self.chat(
+            gen_role=gen_role,
+            stop=self._get_stop_from_role(gen_role),
+            additional_params=additional_params,
+            cb=AskTerminal._add_section_info_to_query_callback(cb, "command"),
+            into="command",
+            cacheable=len(self._history) == 1,
+          )
+        command = command.strip('`')
+        self._history[-1].command = command
+    finally:
+      await self._save_history_item()
+
+    await self._start_prefill(env)
 
     return {
       'thinking': thinking,
@@ -199,7 +393,7 @@ class AskTerminal:
       self._configs.max_observation_tokens,
       truncation_indicator=AskTerminal.TRUNCATION_INDICATOR,
       front_ratio=AskTerminal.TRUNCATION_FRONT_RATIO,
-      coarse_gap=AskTerminal.TRUNCATION_COARSE_GAP,  # approximately 1/3 speed up if coarse gap is 16 and max observation length is 4096
+      coarse_gap=AskTerminal.TRUNCATION_COARSE_GAP,  # for the binary search fallback; approximately 1/3 speed up if coarse gap is 16 and max observation length is 4096
     )
     self._history[-1].observation_received = True
 
@@ -209,22 +403,26 @@ class AskTerminal:
     if self._configs.max_reply_tokens > 0:
       key = {
         'ollama': 'num_predict',
-        'llama-cpp': 'max_tokens',
+        'local-llama': 'n_predict',
         'openai': 'max_tokens',
         'anthropic': 'max_tokens',
-      }[self._tc_endpoint]
+      }[EndpointRegistry.backend_of(self._tc_endpoint, self._tc_cfg)]
 
       additional_params[key] = self._configs.max_reply_tokens
 
-    with self._context_mgr.use_params(env=env, prefix="~~~"):
-      gen_role = f"{self._agent}"
-      reply = await self.chat(
-        gen_role=gen_role,
-        stop=self._get_stop_from_role(gen_role),
-        additional_params=additional_params,
-        cb=AskTerminal._add_section_info_to_query_callback(cb, "reply"),
-      )
-      self._history[-1].reply = reply
+    try:
+      with self._context_mgr.use_params(env=env, prefix="~~~"):
+        gen_role = f"{self._agent}"
+        reply = await self.chat(
+          gen_role=gen_role,
+          stop=self._get_stop_from_role(gen_role),
+          additional_params=additional_params,
+          cb=AskTerminal._add_section_info_to_query_callback(cb, "reply"),
+          into="reply",
+        )
+        self._history[-1].reply = reply
+    finally:
+      await self._save_history_item()
 
     return {
       'reply': reply,
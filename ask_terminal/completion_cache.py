@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .settings import SettingsCompletionCache
+
+
+_logger = logging.getLogger(__name__)
+
+
+class CompletionCache:
+  """
+  Cache of completions keyed by the endpoint, the model, the generation parameters and the prompt,
+  bounded by the number of entries (least recently used evicted first) and their age.
+  Entries can also be persisted to a SQLite database to survive restarts.
+  """
+
+  IGNORED_PARAMS = ('stream',)  # do not affect the completion
+
+  def __init__(self, max_entries=1024, ttl=0, path=None):
+    self.max_entries = max_entries
+    self.ttl = ttl
+
+    self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()  # key -> (completion, created_at)
+    self._num_hits = 0
+    self._num_misses = 0
+
+    self._db = None
+    if path is not None:
+      path = Path(path).expanduser()
+      path.parent.mkdir(parents=True, exist_ok=True)
+
+      self._lock = threading.Lock()
+      self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+      self._db.execute("PRAGMA journal_mode=WAL")
+      with self._db:
+        self._db.execute("""
+          CREATE TABLE IF NOT EXISTS completions (
+            key TEXT PRIMARY KEY,
+            completion TEXT NOT NULL,
+            created_at REAL NOT NULL
+          )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_created_at ON completions (created_at)")
+        self._prune()
+
+  @staticmethod
+  def from_settings(settings: SettingsCompletionCache) -> Optional['CompletionCache']:
+    if not settings.enabled:
+      return None
+    return CompletionCache(
+      max_entries=settings.max_entries,
+      ttl=settings.ttl,
+      path=settings.path,
+    )
+
+  @staticmethod
+  def make_key(endpoint: str, model_name: Optional[str], params: Dict, prompt: str):
+    params = { k: v for k, v in params.items() if k not in CompletionCache.IGNORED_PARAMS }
+    data = json.dumps([endpoint, model_name, params, prompt], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+  async def get(self, key) -> Optional[str]:
+    entry = self._entries.get(key)
+    if entry is None and self._db is not None:
+      entry = await asyncio.to_thread(self._load, key)
+      if entry is not None:
+        self._add(key, entry)
+
+    if entry is not None and self._expired(entry):
+      self._entries.pop(key, None)
+      entry = None
+
+    if entry is None:
+      self._num_misses += 1
+      return None
+
+    self._entries.move_to_end(key)
+    self._num_hits += 1
+    return entry[0]
+
+  async def put(self, key, completion: str):
+    entry = (completion, time.time())
+    self._add(key, entry)
+    if self._db is not None:
+      await asyncio.to_thread(self._save, key, entry)
+
+  def stats(self):
+    return {
+      'num_entries': len(self._entries),
+      'hits': self._num_hits,
+      'misses': self._num_misses,
+    }
+
+  def close(self):
+    if self._db is not None:
+      with self._lock:
+        self._db.close()
+      self._db = None
+
+  def _add(self, key, entry):
+    self._entries[key] = entry
+    self._entries.move_to_end(key)
+    while self.max_entries > 0 and len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+
+  def _expired(self, entry):
+    return self.ttl > 0 and entry[1] < time.time() - self.ttl
+
+  def _load(self, key):
+    with self._lock:
+      row = self._db.execute("SELECT completion, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+    return tuple(row) if row is not None else None
+
+  def _save(self, key, entry):
+    with self._lock, self._db:
+      self._db.execute(
+        "INSERT OR REPLACE INTO completions (key, completion, created_at) VALUES (?, ?, ?)",
+        (key, *entry),
+      )
+      self._prune()
+
+  def _prune(self):
+    """
+    Delete the expired rows and the oldest rows beyond `max_entries`, within the transaction of the caller.
+    """
+    if self.ttl > 0:
+      self._db.execute("DELETE FROM completions WHERE created_at < ?", (time.time() - self.ttl,))
+    if self.max_entries > 0:
+      self._db.execute(
+        "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (self.max_entries,),
+      )
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from .conversation_store import ConversationStore
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ConversationBusyError(Exception):
+  pass
+
+async def _acquire(lock: asyncio.Lock, timeout: Optional[float]):
+  """
+  Acquire `lock` or raise `asyncio.TimeoutError` after `timeout` seconds. Unlike `asyncio.wait_for`
+  before Python 3.12, the lock is never left held when the acquisition times out or is cancelled.
+  """
+  if timeout is None:
+    await lock.acquire()
+    return
+
+  if hasattr(asyncio, 'timeout'):  # python >= 3.11
+    async with asyncio.timeout(timeout):
+      await lock.acquire()
+    return
+
+  acquire = asyncio.ensure_future(lock.acquire())
+  try:
+    await asyncio.wait([acquire], timeout=timeout)
+  except BaseException:
+    if acquire.done() and not acquire.cancelled():
+      lock.release()
+    acquire.cancel()
+    raise
+  if not acquire.done():
+    acquire.cancel()  # a cancelled acquisition does not take the lock, even if just woken up
+    raise asyncio.TimeoutError()
+
+class ConversationLocks:
+  """
+  Serialize the requests on the same conversation: with asyncio locks within the process,
+  and with the lock of the conversation store, if any, among the server processes sharing it.
+  Requests are served in the order they arrive, and rejected with `ConversationBusyError`
+  if too many are queued already or if they have waited for too long.
+  """
+
+  def __init__(self, max_queued=0, timeout=0):
+    """
+    Params
+    ======
+    max_queued:
+      maximum number of requests waiting for the lock of a conversation; 0 for unlimited
+    timeout:
+      seconds a request waits for the lock before being rejected; 0 to wait forever
+    """
+    self.max_queued = max_queued
+    self.timeout = timeout
+
+    self._locks: Dict[str, asyncio.Lock] = {}
+    self._num_users: Dict[str, int] = {}  # holding or waiting for the lock
+
+  def __len__(self):
+    return len(self._locks)
+
+  def in_use(self, conversation_id: str):
+    """
+    Whether a request holds or waits for the lock of the conversation.
+    """
+    return conversation_id in self._num_users
+
+  @asynccontextmanager
+  async def hold(self, conversation_id: str, store: Optional[ConversationStore]=None):
+    num_users = self._num_users.get(conversation_id, 0)
+    if self.max_queued > 0 and num_users > self.max_queued:  # one holding the lock, the rest waiting
+      raise ConversationBusyError(f"Too many requests queued on conversation '{conversation_id}'")
+
+    lock = self._locks.setdefault(conversation_id, asyncio.Lock())
+    self._num_users[conversation_id] = num_users + 1
+    deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+
+    try:
+      try:
+        await _acquire(lock, self.timeout if self.timeout > 0 else None)
+      except asyncio.TimeoutError:
+        raise ConversationBusyError(f"Timed out waiting for conversation '{conversation_id}'")
+
+      try:
+        owner = None
+        if store is not None:
+          try:
+            owner = await store.acquire_lock(conversation_id, timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+          except asyncio.TimeoutError:
+            raise ConversationBusyError(f"Timed out waiting for conversation '{conversation_id}'")
+
+          renewal = asyncio.create_task(ConversationLocks._renew(store, conversation_id, owner))
+
+        try:
+          yield
+        finally:
+          if owner is not None:
+            renewal.cancel()
+            await store.release_lock(conversation_id, owner)
+      finally:
+        lock.release()
+    finally:
+      self._num_users[conversation_id] -= 1
+      if self._num_users[conversation_id] == 0:
+        del self._num_users[conversation_id]
+        del self._locks[conversation_id]
+
+  @staticmethod
+  async def _renew(store: ConversationStore, conversation_id: str, owner: str):
+    """
+    Renew the lock of the store while it is held, so that it does not expire during a long request.
+    """
+    while True:
+      await asyncio.sleep(store.lock_timeout / 3)
+      try:
+        renewed = await store.renew_lock(conversation_id, owner)
+      except Exception as e:  # retried at the next interval, before the lock expires
+        _logger.warning(f"Failed to renew the lock of conversation '{conversation_id}': {e}")
+        continue
+      if not renewed:
+        _logger.warning(f"Lost the lock of conversation '{conversation_id}', it expired before being renewed")
+        return
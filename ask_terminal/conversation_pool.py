@@ -0,0 +1,133 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from .ask_terminal import AskTerminal
+from .settings import SettingsConversationPool
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ConversationPool:
+  """
+  Conversations kept in memory, bounded by the number of conversations, the idle time
+  and the estimated memory. The least recently used conversations are evicted first,
+  except those in use, which would lose their turn in progress.
+  """
+
+  def __init__(self, max_conversations=0, idle_ttl=0, max_memory_mb=0, in_use: Callable[[str], bool]=lambda conversation_id: False):
+    """
+    Params
+    ======
+    in_use:
+      whether a conversation has requests in progress or waiting, and must not be evicted
+    """
+    self.max_conversations = max_conversations
+    self.idle_ttl = idle_ttl
+    self.max_memory = int(max_memory_mb * 1024 * 1024)
+    self.in_use = in_use
+
+    self._conversations: OrderedDict[str, AskTerminal] = OrderedDict()  # least recently used first
+    self._last_access: Dict[str, float] = {}
+    self._memory: Dict[str, int] = {}
+    self._total_memory = 0
+    self._num_evicted = 0
+
+  @staticmethod
+  def from_settings(settings: SettingsConversationPool, **kwargs):
+    return ConversationPool(
+      max_conversations=settings.max_conversations,
+      idle_ttl=settings.idle_ttl,
+      max_memory_mb=settings.max_memory_mb,
+      **kwargs,
+    )
+
+  def __contains__(self, conversation_id):
+    self.evict_expired()
+    return conversation_id in self._conversations
+
+  def __len__(self):
+    return len(self._conversations)
+
+  def get(self, conversation_id) -> Optional[AskTerminal]:
+    self.evict_expired()
+
+    conversation = self._conversations.get(conversation_id)
+    if conversation is not None:
+      self._touch(conversation_id)
+
+    return conversation
+
+  def add(self, conversation_id, conversation: AskTerminal):
+    self.evict_expired()
+
+    self._conversations[conversation_id] = conversation
+    self._touch(conversation_id)
+    self._set_memory(conversation_id, conversation.estimate_memory())
+
+    self._evict_over_limits()
+
+  def update(self, conversation_id):
+    """
+    Update the memory estimate of a conversation after it has changed.
+    """
+    conversation = self._conversations.get(conversation_id)
+    if conversation is None:
+      return
+
+    self._set_memory(conversation_id, conversation.estimate_memory())
+    self._evict_over_limits()
+
+  def remove(self, conversation_id) -> bool:
+    conversation = self._conversations.pop(conversation_id, None)
+    if conversation is None:
+      return False
+
+    del self._last_access[conversation_id]
+    self._total_memory -= self._memory.pop(conversation_id)
+    conversation.close()
+
+    return True
+
+  def evict_expired(self):
+    if self.idle_ttl <= 0:
+      return
+
+    deadline = time.monotonic() - self.idle_ttl
+    for conversation_id in list(self._conversations):
+      if self._last_access[conversation_id] > deadline:
+        break
+      if not self.in_use(conversation_id):
+        self._evict(conversation_id, reason="idle")
+
+  def stats(self):
+    return {
+      'num_conversations': len(self._conversations),
+      'memory': self._total_memory,
+      'num_evicted': self._num_evicted,
+    }
+
+  def _touch(self, conversation_id):
+    self._conversations.move_to_end(conversation_id)
+    self._last_access[conversation_id] = time.monotonic()
+
+  def _set_memory(self, conversation_id, memory):
+    self._total_memory += memory - self._memory.get(conversation_id, 0)
+    self._memory[conversation_id] = memory
+
+  def _evict(self, conversation_id, reason):
+    self.remove(conversation_id)
+    self._num_evicted += 1
+    _logger.debug(f"Evicted conversation '{conversation_id}' ({reason})")
+
+  def _evict_over_limits(self):
+    # never evict the most recently used conversation, which is the one being added or updated
+    for conversation_id in list(self._conversations)[:-1]:
+      over_count = self.max_conversations > 0 and len(self._conversations) > self.max_conversations
+      over_memory = self.max_memory > 0 and self._total_memory > self.max_memory
+      if not (over_count or over_memory):
+        break
+      if not self.in_use(conversation_id):
+        self._evict(conversation_id, reason="count" if over_count else "memory")
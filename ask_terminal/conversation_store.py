@@ -0,0 +1,379 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .libs.resp_client import RespClient
+from .settings import SettingsConversationStore
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+  """
+  Persistent storage of conversations. A conversation is stored as its init config,
+  plus its history items, each of which is written on its own as it changes.
+
+  Every write bumps the version of the conversation, so that a server process can tell
+  whether its copy in memory is stale, and `lock` serializes the updates to a conversation
+  among all the server processes sharing the store.
+  """
+
+  LOCK_POLL_INTERVAL = 0.05
+
+  def __init__(self, lock_timeout=600):
+    """
+    Params
+    ======
+    lock_timeout:
+      seconds after which a lock that is not renewed is considered abandoned, e.g. by a crashed process
+    """
+    self.lock_timeout = lock_timeout
+
+  async def create(self, conversation_id: str, init_cfg: Dict) -> bool:
+    """
+    Returns False if the conversation already exists.
+    """
+    raise NotImplementedError()
+
+  async def save_item(self, conversation_id: str, index: int, item: Dict) -> int:
+    """
+    Returns the new version of the conversation, or 0 if it does not exist (anymore), e.g. deleted
+    or purged meanwhile, in which case the item is not saved.
+    """
+    raise NotImplementedError()
+
+  async def load(self, conversation_id: str) -> Optional[Tuple[Dict, List[Dict], int]]:
+    """
+    Returns the init config, the history items and the version of the conversation, or None if it does not exist.
+    """
+    raise NotImplementedError()
+
+  async def version(self, conversation_id: str) -> Optional[int]:
+    raise NotImplementedError()
+
+  async def delete(self, conversation_id: str) -> bool:
+    raise NotImplementedError()
+
+  async def purge(self, retention: float) -> int:
+    """
+    Delete the conversations not updated in the last `retention` seconds.
+    Returns the number of conversations deleted.
+    """
+    raise NotImplementedError()
+
+  async def close(self):
+    pass
+
+  async def acquire_lock(self, conversation_id: str, timeout: Optional[float]=None) -> str:
+    """
+    Wait for the lock of the conversation, and return the owner token to release it with.
+    Raises `asyncio.TimeoutError` after `timeout` seconds.
+    """
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not await self._try_lock(conversation_id, owner):
+      if deadline is not None and time.monotonic() >= deadline:
+        raise asyncio.TimeoutError()
+      await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+
+    return owner
+
+  async def renew_lock(self, conversation_id: str, owner: str) -> bool:
+    """
+    Extend the lock for another `lock_timeout` seconds. Returns False if `owner` no longer holds it.
+    """
+    raise NotImplementedError()
+
+  async def release_lock(self, conversation_id: str, owner: str):
+    raise NotImplementedError()
+
+  async def _try_lock(self, conversation_id: str, owner: str) -> bool:
+    raise NotImplementedError()
+
+  @staticmethod
+  def from_settings(settings: SettingsConversationStore) -> Optional['ConversationStore']:
+    if settings.backend == 'memory':
+      return None
+    elif settings.backend == 'sqlite':
+      return SQLiteConversationStore(settings.path, lock_timeout=settings.lock_timeout)
+    elif settings.backend == 'redis':
+      return RedisConversationStore(settings.url, retention=settings.retention, lock_timeout=settings.lock_timeout)
+    else:
+      raise ValueError(f"Invalid conversation store backend '{settings.backend}'")
+
+class SQLiteConversationStore(ConversationStore):
+  """
+  Conversation store backed by a SQLite database in WAL mode, so that multiple server
+  processes can share it. Queries are run in worker threads to keep the event loop free.
+  """
+
+  def __init__(self, path, lock_timeout=600):
+    super().__init__(lock_timeout=lock_timeout)
+
+    self.path = Path(path).expanduser()
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.executescript("""
+      CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        init_cfg TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL
+      );
+      CREATE TABLE IF NOT EXISTS history_items (
+        conversation_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        PRIMARY KEY (conversation_id, idx)
+      );
+      CREATE TABLE IF NOT EXISTS locks (
+        conversation_id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+    """)
+
+    _logger.info(f"Storing conversations in '{self.path}'")
+
+  async def create(self, conversation_id, init_cfg):
+    return await asyncio.to_thread(self._create, conversation_id, init_cfg)
+
+  async def save_item(self, conversation_id, index, item):
+    return await asyncio.to_thread(self._save_item, conversation_id, index, item)
+
+  async def load(self, conversation_id):
+    return await asyncio.to_thread(self._load, conversation_id)
+
+  async def version(self, conversation_id):
+    return await asyncio.to_thread(self._version, conversation_id)
+
+  async def delete(self, conversation_id):
+    return await asyncio.to_thread(self._delete, [conversation_id]) > 0
+
+  async def purge(self, retention):
+    return await asyncio.to_thread(self._purge, retention)
+
+  async def close(self):
+    with self._lock:
+      self._db.close()
+
+  async def renew_lock(self, conversation_id, owner):
+    return await asyncio.to_thread(self._renew_lock_sync, conversation_id, owner)
+
+  async def release_lock(self, conversation_id, owner):
+    await asyncio.to_thread(self._release_lock_sync, conversation_id, owner)
+
+  async def _try_lock(self, conversation_id, owner):
+    return await asyncio.to_thread(self._try_lock_sync, conversation_id, owner)
+
+  def _create(self, conversation_id, init_cfg):
+    with self._lock, self._db:
+      cursor = self._db.execute(
+        "INSERT OR IGNORE INTO conversations (id, init_cfg, updated_at) VALUES (?, ?, ?)",
+        (conversation_id, json.dumps(init_cfg), time.time()),
+      )
+      return cursor.rowcount > 0
+
+  def _save_item(self, conversation_id, index, item):
+    with self._lock, self._db:
+      cursor = self._db.execute(
+        "UPDATE conversations SET version = version + 1, updated_at = ? WHERE id = ?",
+        (time.time(), conversation_id),
+      )
+      if cursor.rowcount == 0:  # the items of a deleted conversation would never be deleted
+        return 0
+
+      self._db.execute(
+        "INSERT INTO history_items (conversation_id, idx, item) VALUES (?, ?, ?)"
+        " ON CONFLICT (conversation_id, idx) DO UPDATE SET item = excluded.item",
+        (conversation_id, index, json.dumps(item, ensure_ascii=False)),
+      )
+      row = self._db.execute(
+        "SELECT version FROM conversations WHERE id = ?",
+        (conversation_id,),
+      ).fetchone()
+      return row[0] if row is not None else 0
+
+  def _load(self, conversation_id):
+    with self._lock, self._db:
+      self._db.execute("BEGIN")  # read the conversation and its items from the same snapshot
+      row = self._db.execute(
+        "SELECT init_cfg, version FROM conversations WHERE id = ?",
+        (conversation_id,),
+      ).fetchone()
+      if row is None:
+        return None
+
+      items = self._db.execute(
+        "SELECT item FROM history_items WHERE conversation_id = ? ORDER BY idx",
+        (conversation_id,),
+      ).fetchall()
+
+    return json.loads(row[0]), [json.loads(item) for item, in items], row[1]
+
+  def _version(self, conversation_id):
+    with self._lock:
+      row = self._db.execute(
+        "SELECT version FROM conversations WHERE id = ?",
+        (conversation_id,),
+      ).fetchone()
+    return row[0] if row is not None else None
+
+  def _delete(self, conversation_ids):
+    with self._lock, self._db:
+      params = [(conversation_id,) for conversation_id in conversation_ids]
+      self._db.executemany("DELETE FROM history_items WHERE conversation_id = ?", params)
+      cursor = self._db.executemany("DELETE FROM conversations WHERE id = ?", params)
+      return cursor.rowcount
+
+  def _purge(self, retention):
+    if retention <= 0:
+      return 0
+
+    with self._lock:
+      rows = self._db.execute(
+        "SELECT id FROM conversations WHERE updated_at < ?",
+        (time.time() - retention,),
+      ).fetchall()
+
+    if len(rows) == 0:
+      return 0
+    return self._delete([conversation_id for conversation_id, in rows])
+
+  def _try_lock_sync(self, conversation_id, owner):
+    now = time.time()
+    with self._lock, self._db:
+      cursor = self._db.execute(
+        "INSERT INTO locks (conversation_id, owner, expires_at) VALUES (?, ?, ?)"
+        " ON CONFLICT (conversation_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+        " WHERE locks.expires_at < ?",
+        (conversation_id, owner, now + self.lock_timeout, now),
+      )
+      return cursor.rowcount > 0
+
+  def _renew_lock_sync(self, conversation_id, owner):
+    with self._lock, self._db:
+      cursor = self._db.execute(
+        "UPDATE locks SET expires_at = ? WHERE conversation_id = ? AND owner = ?",
+        (time.time() + self.lock_timeout, conversation_id, owner),
+      )
+      return cursor.rowcount > 0
+
+  def _release_lock_sync(self, conversation_id, owner):
+    with self._lock, self._db:
+      self._db.execute(
+        "DELETE FROM locks WHERE conversation_id = ? AND owner = ?",
+        (conversation_id, owner),
+      )
+
+class RedisConversationStore(ConversationStore):
+  """
+  Conversation store on a Redis compatible server. Conversations expire by themselves
+  after the retention period, so there is nothing to purge.
+  """
+
+  KEY_PREFIX = "ask-terminal"
+
+  # delete the lock only if still ours, it may have expired and been taken by another process
+  RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+  RENEW_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+  # the writes of a conversation are made by scripts, which Redis runs atomically
+  CREATE_SCRIPT = """
+    if redis.call('hsetnx', KEYS[1], 'init_cfg', ARGV[1]) == 0 then return 0 end
+    redis.call('hset', KEYS[1], 'version', 0)
+    if tonumber(ARGV[2]) > 0 then redis.call('expire', KEYS[1], ARGV[2]) end
+    return 1
+  """
+  SAVE_ITEM_SCRIPT = """
+    if redis.call('exists', KEYS[1]) == 0 then return 0 end
+    redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+    local version = redis.call('hincrby', KEYS[1], 'version', 1)
+    if tonumber(ARGV[3]) > 0 then
+      redis.call('expire', KEYS[1], ARGV[3])
+      redis.call('expire', KEYS[2], ARGV[3])
+    end
+    return version
+  """
+
+  def __init__(self, url, retention=0, lock_timeout=600):
+    super().__init__(lock_timeout=lock_timeout)
+
+    self.retention = retention
+    self._client = RespClient(url)
+
+    _logger.info(f"Storing conversations in '{self._client.host}:{self._client.port}/{self._client.db}'")
+
+  async def create(self, conversation_id, init_cfg):
+    created = await self._client.execute(
+      'EVAL', self.CREATE_SCRIPT, 1,
+      self._key('conversation', conversation_id),
+      json.dumps(init_cfg), int(self.retention),
+    )
+    return created == 1
+
+  async def save_item(self, conversation_id, index, item):
+    return await self._client.execute(
+      'EVAL', self.SAVE_ITEM_SCRIPT, 2,
+      self._key('conversation', conversation_id), self._key('items', conversation_id),
+      index, json.dumps(item, ensure_ascii=False), int(self.retention),
+    )
+
+  async def load(self, conversation_id):
+    conversation = RedisConversationStore._to_dict(await self._client.execute('HGETALL', self._key('conversation', conversation_id)))
+    if b'init_cfg' not in conversation:
+      return None
+
+    items = RedisConversationStore._to_dict(await self._client.execute('HGETALL', self._key('items', conversation_id)))
+    items = [json.loads(items[idx]) for idx in sorted(items, key=int)]
+
+    return json.loads(conversation[b'init_cfg']), items, int(conversation.get(b'version', 0))
+
+  async def version(self, conversation_id):
+    version = await self._client.execute('HGET', self._key('conversation', conversation_id), 'version')
+    return int(version) if version is not None else None
+
+  async def delete(self, conversation_id):
+    num_deleted = await self._client.execute(
+      'DEL',
+      self._key('conversation', conversation_id),
+      self._key('items', conversation_id),
+    )
+    return num_deleted > 0
+
+  async def purge(self, retention):
+    return 0
+
+  async def close(self):
+    await self._client.close()
+
+  async def renew_lock(self, conversation_id, owner):
+    renewed = await self._client.execute(
+      'EVAL', self.RENEW_LOCK_SCRIPT, 1, self._key('lock', conversation_id), owner, int(self.lock_timeout * 1000),
+    )
+    return renewed == 1
+
+  async def release_lock(self, conversation_id, owner):
+    await self._client.execute('EVAL', self.RELEASE_LOCK_SCRIPT, 1, self._key('lock', conversation_id), owner)
+
+  async def _try_lock(self, conversation_id, owner):
+    key = self._key('lock', conversation_id)
+    return await self._client.execute('SET', key, owner, 'NX', 'PX', int(self.lock_timeout * 1000)) is not None
+
+  def _key(self, kind, conversation_id):
+    return f"{self.KEY_PREFIX}:{kind}:{conversation_id}"
+
+  @staticmethod
+  def _to_dict(flat: List):
+    return dict(zip(flat[::2], flat[1::2]))
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+from .libs.endpoint_group import EndpointGroup
+from .libs.text_completion_endpoint import TextCompletionBase, LLamaTextCompletion, OpenAITextCompletion, AnthropicTextCompletion, OllamaTextCompletion
+from .utils import load_credentials
+
+
+_logger = logging.getLogger(__name__)
+
+
+class EndpointRegistry:
+  """
+  Build the text completion backend of each (endpoint, model, credentials) once,
+  and share it among all the conversations using it, along with its client and tokenizer.
+
+  The type of an endpoint is its name, unless set by its `type` field. An endpoint of type `group`
+  spreads the requests over its `members`, endpoints of the type set by its `endpoint` field,
+  configured by the fields of the group overridden by their own.
+  """
+
+  GROUP_FIELDS = ('type', 'endpoint', 'members', 'balance', 'sticky', 'sticky_max_imbalance', 'health_check_interval', 'health_check_timeout', 'failure_cooldown')
+
+  def __init__(self):
+    self._instances: Dict[tuple, TextCompletionBase] = {}
+
+  def get(self, endpoint: str, endpoint_cfg: Dict, model_name: Optional[str]=None) -> TextCompletionBase:
+    model_name = model_name or endpoint_cfg.get('model', None)
+    key = (endpoint, model_name, json.dumps(endpoint_cfg, sort_keys=True, default=str))
+
+    tc = self._instances.get(key)
+    if tc is None:
+      try:
+        tc = EndpointRegistry._create(endpoint, endpoint_cfg, model_name)
+      except ImportError as e:
+        raise ValueError(f"Endpoint '{endpoint}' is not installed ({e.name} is missing), try `pip install ask-terminal[{EndpointRegistry.backend_of(endpoint, endpoint_cfg)}]`") from e
+      self._instances[key] = tc
+      _logger.debug(f"Created text completion backend for endpoint '{endpoint}' (model: {model_name})")
+
+    return tc
+
+  async def warm_up(self, endpoint: str, endpoint_cfg: Dict, model_name: Optional[str]=None):
+    """
+    Build the backend and load its heavy resources, such as tokenizers, ahead of the first request.
+    The resources are loaded in a worker thread.
+    """
+    tc = self.get(endpoint, endpoint_cfg, model_name=model_name)
+    await asyncio.to_thread(tc.warm_up)
+
+  def stats(self):
+    return [
+      {
+        'endpoint': endpoint,
+        'model': model_name,
+        'token_count_cache': tc.token_counts.stats(),
+        **({ 'members': tc.stats() } if isinstance(tc, EndpointGroup) else { 'resilience': tc.resilience.stats() }),
+      }
+      for (endpoint, model_name, _), tc in self._instances.items()
+    ]
+
+  def close(self):
+    for tc in self._instances.values():
+      tc.close()
+
+  def clear(self):
+    self.close()
+    self._instances.clear()
+
+  @staticmethod
+  def backend_of(endpoint: str, endpoint_cfg: Dict) -> str:
+    """
+    Type of the backend serving the endpoint, that of the members for a group.
+    """
+    endpoint_type = endpoint_cfg.get('type', endpoint)
+    if endpoint_type == 'group':
+      return endpoint_cfg.get('endpoint', None)
+    return endpoint_type
+
+  @staticmethod
+  def _load_api_key(endpoint_cfg: Dict):
+    creds_file = endpoint_cfg.get('credentials', None)
+    if not creds_file:
+      return None
+    return load_credentials(creds_file).get('api_key', None)
+
+  @staticmethod
+  def _create_group(endpoint: str, endpoint_cfg: Dict, model_name: Optional[str]) -> EndpointGroup:
+    member_endpoint = endpoint_cfg.get('endpoint', None)
+    if member_endpoint is None or member_endpoint == 'group':
+      raise ValueError(f"Endpoint group '{endpoint}' requires the `endpoint` of its members")
+
+    shared_cfg = { k: v for k, v in endpoint_cfg.items() if k not in EndpointRegistry.GROUP_FIELDS }
+    members = []
+    weights = []
+    for member_cfg in endpoint_cfg.get('members', []):
+      member_cfg = { **shared_cfg, **member_cfg }
+      # failing over to another member rather than retrying the same one, unless set otherwise
+      member_cfg['resilience'] = { 'max_retries': 0, **(member_cfg.get('resilience', None) or {}) }
+      weights.append(member_cfg.pop('weight', 1))
+      members.append(EndpointRegistry._create(member_endpoint, member_cfg, model_name))
+
+    return EndpointGroup(
+      members,
+      weights=weights,
+      logger=logging.getLogger('text-completion'),
+      balance=endpoint_cfg.get('balance', 'least_outstanding'),
+      sticky=endpoint_cfg.get('sticky', True),
+      sticky_max_imbalance=endpoint_cfg.get('sticky_max_imbalance', 4),
+      health_check_interval=endpoint_cfg.get('health_check_interval', 10),
+      health_check_timeout=endpoint_cfg.get('health_check_timeout', 5),
+      failure_cooldown=endpoint_cfg.get('failure_cooldown', 30),
+    )
+
+  @staticmethod
+  def _create(endpoint: str, endpoint_cfg: Dict, model_name: Optional[str]) -> TextCompletionBase:
+    tc_logger = logging.getLogger('text-completion')
+
+    endpoint_type = endpoint_cfg.get('type', endpoint)
+    if endpoint_type == 'group':
+      return EndpointRegistry._create_group(endpoint, endpoint_cfg, model_name)
+    elif endpoint_type == 'ollama':
+      return OllamaTextCompletion(
+        server_url=endpoint_cfg['server_url'],
+        model_name=model_name,
+        logger=tc_logger,
+        connection=endpoint_cfg.get('connection', None),
+        resilience=endpoint_cfg.get('resilience', None),
+      )
+    elif endpoint_type == 'local-llama':
+      return LLamaTextCompletion(
+        server_url=endpoint_cfg['server_url'],
+        logger=tc_logger,
+        connection=endpoint_cfg.get('connection', None),
+        cache_prompt=endpoint_cfg.get('cache_prompt', True),
+        slots=endpoint_cfg.get('slots', None),
+        resilience=endpoint_cfg.get('resilience', None),
+      )
+    elif endpoint_type == 'openai':
+      return OpenAITextCompletion(
+        model_name=model_name,
+        api_key=EndpointRegistry._load_api_key(endpoint_cfg),
+        logger=tc_logger,
+        connection=endpoint_cfg.get('connection', None),
+        resilience=endpoint_cfg.get('resilience', None),
+      )
+    elif endpoint_type == 'anthropic':
+      return AnthropicTextCompletion(
+        model_name=model_name,
+        api_key=EndpointRegistry._load_api_key(endpoint_cfg),
+        logger=tc_logger,
+        initial_system_msg=endpoint_cfg.get('initial_system_msg', None),
+        connection=endpoint_cfg.get('connection', None),
+        resilience=endpoint_cfg.get('resilience', None),
+      )
+    else:
+      raise ValueError(f"Invalid endpoint '{endpoint_type}'")
+
+endpoint_registry = EndpointRegistry()
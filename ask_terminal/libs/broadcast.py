@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, Awaitable, List
+
+
+class Broadcast:
+  """
+  Run a coroutine once and share its events and result among any number of subscribers.
+  A subscriber that joins late gets the events published so far replayed, then the new ones.
+  The coroutine is cancelled once all its subscribers have gone away before it is done.
+  """
+
+  def __init__(self, coro: Awaitable):
+    self.events: List[Any] = []
+    self.num_subscribers = 0
+
+    self._changed = asyncio.Event()
+    self.task = asyncio.ensure_future(coro)
+    self.task.add_done_callback(lambda _: self._notify())
+
+  def publish(self, event):
+    self.events.append(event)
+    self._notify()
+
+  def done(self):
+    return self.task.done()
+
+  def wake(self):
+    """
+    Wake up the subscribers without a new event, e.g. from a timer.
+    """
+    self._notify()
+
+  async def result(self):
+    self.num_subscribers += 1
+    try:
+      # shielded, so that a subscriber going away does not cancel the others
+      return await asyncio.shield(self.task)
+    finally:
+      self._unsubscribe()
+
+  async def subscribe(self):
+    """
+    Yield the events until the coroutine is done, in lists of all the events published since
+    the previous list. The list is empty if the subscribers have been woken up by `wake`.
+    """
+    self.num_subscribers += 1
+    try:
+      idx = 0
+      woken = False
+      while True:
+        changed = self._changed
+        batch = self.events[idx:]
+        idx += len(batch)
+        if len(batch) > 0 or woken:
+          yield batch
+
+        if self.task.done() and idx == len(self.events):
+          break
+        await changed.wait()
+        woken = True
+    finally:
+      self._unsubscribe()
+
+  def _unsubscribe(self):
+    self.num_subscribers -= 1
+    if self.num_subscribers == 0 and not self.task.done():
+      self.task.cancel()
+
+  def _notify(self):
+    self._changed.set()
+    self._changed = asyncio.Event()
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from typing import Callable, List, Literal, Optional
+
+from ask_terminal.utils import auto_async
+from .text_completion_endpoint import TextCompletionBase, is_transient_error
+
+
+class EndpointGroupMember:
+  def __init__(self, tc: TextCompletionBase, weight=1, name=''):
+    self.tc = tc
+    self.weight = weight
+    self.name = name  # identifies the member in the hashing of the conversations
+
+    self.outstanding = 0  # requests in progress
+    self.num_requests = 0
+    self.num_failures = 0
+    self.down_until = 0.0  # skipped until then (monotonic time), after a failed request
+    self.healthy = True  # False from a failed health check until one succeeds
+    self.current_weight = 0  # for the smooth weighted round robin
+
+  def is_up(self, now):
+    return self.healthy and self.down_until <= now and self.tc.resilience.circuit_breaker.state != 'open'
+
+  def stats(self):
+    return {
+      'server_url': getattr(self.tc, 'server_url', None),
+      'weight': self.weight,
+      'up': self.is_up(time.monotonic()),
+      'outstanding': self.outstanding,
+      'num_requests': self.num_requests,
+      'num_failures': self.num_failures,
+      'circuit': self.tc.resilience.circuit_breaker.state,
+    }
+
+class EndpointGroup(TextCompletionBase):
+  """
+  Spread the requests over several servers of the same endpoint. A conversation sticks to a
+  member, so that the member keeps the KV cache of its prompt, until that member goes down.
+  The member is picked by hashing the id of the conversation, so that all the server processes
+  agree on it, and only the conversations of a member that goes down move to other members.
+  A request leaves its member for `balance` when that member is much busier than the others.
+  A member is down after a failed request, for `failure_cooldown` seconds, and after a failed
+  health check, until a health check succeeds. A completion that fails before anything has been
+  streamed is retried on another member, and a member whose circuit breaker is open is skipped.
+  """
+
+  def __init__(
+      self, members: List[TextCompletionBase], weights: Optional[List[int]]=None, logger: logging.Logger=None,
+      balance: Literal['least_outstanding', 'weighted']='least_outstanding', sticky=True, sticky_max_imbalance: float=4,
+      health_check_interval: float=10, health_check_timeout: float=5, failure_cooldown: float=30,
+    ):
+    """
+    Params
+    ======
+    balance:
+      for the requests that do not stick to a member, `least_outstanding` picks the member with the
+      fewest requests in progress relative to its weight, `weighted` spreads the requests in proportion
+      to the weights
+
+    sticky:
+      keep sending the requests of a conversation to the same member; the conversations are spread
+      in proportion to the weights
+
+    sticky_max_imbalance:
+      a request of a conversation goes to the member picked by `balance` instead, when its own member
+      has more requests in progress than the least busy member by this much, relative to the weights;
+      0 to always stick
+
+    health_check_interval:
+      seconds between health checks of the members, 0 to only rely on failed requests
+    """
+    if len(members) == 0:
+      raise ValueError("An endpoint group requires at least one member")
+    if balance not in ('least_outstanding', 'weighted'):
+      raise ValueError(f"Invalid balance '{balance}'")
+
+    super().__init__()
+    weights = weights or [1]*len(members)
+    self.members = [
+      EndpointGroupMember(tc, weight, name=f"{idx}:{getattr(tc, 'server_url', '')}")
+      for idx, (tc, weight) in enumerate(zip(members, weights))
+    ]
+    self.logger = logger
+    self.balance = balance
+    self.sticky = sticky
+    self.sticky_max_imbalance = sticky_max_imbalance
+    self.health_check_interval = health_check_interval
+    self.health_check_timeout = health_check_timeout
+    self.failure_cooldown = failure_cooldown
+
+    self._health_check_task: Optional[asyncio.Task] = None
+
+  def warm_up(self):
+    for member in self.members:
+      member.tc.warm_up()
+
+  def close(self):
+    if self._health_check_task is not None:
+      self._health_check_task.cancel()
+      self._health_check_task = None
+    for member in self.members:
+      member.tc.close()
+
+  def stats(self):
+    return [member.stats() for member in self.members]
+
+  async def tokenize(self, content):
+    return await self._call(None, lambda tc: tc.tokenize(content))
+
+  async def token_offsets(self, content):
+    return await self._call(None, lambda tc: tc.token_offsets(content))
+
+  async def _truncate_count_tokens(self, content):
+    return await self._call(None, lambda tc: tc._truncate_count_tokens(content))
+
+  async def create(self, *args, params={}, cb=None, conversation_id=None, **kwargs):
+    cb = auto_async(cb)
+    streamed = False
+
+    async def forward(**kwargs):
+      nonlocal streamed
+      streamed = True
+      if cb is not None:
+        await cb(**kwargs)
+
+    # the params are copied, as backends add their own fields to them, e.g. the slot of the server
+    return await self._call(
+      conversation_id,
+      lambda tc: tc.create(*args, params=dict(params), cb=forward, conversation_id=conversation_id, **kwargs),
+      can_retry=lambda: not streamed,
+    )
+
+  def release_conversation(self, conversation_id):
+    for member in self.members:
+      member.tc.release_conversation(conversation_id)
+
+  @property
+  def supports_prefill(self):
+    return self.members[0].tc.supports_prefill
+
+  async def prefill(self, prompt, conversation_id=None):
+    await self._call(conversation_id, lambda tc: tc.prefill(prompt, conversation_id=conversation_id))
+
+  async def _call(self, conversation_id, request: Callable, can_retry: Callable=lambda: True):
+    """
+    Run `request` on a member, then on the next one as long as the members fail and `can_retry`.
+    """
+    self._start_health_checks()
+
+    tried = []
+    while True:
+      member = self._pick(conversation_id, tried)
+      member.outstanding += 1
+      member.num_requests += 1
+      try:
+        return await request(member.tc)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        if not is_transient_error(e):
+          raise
+
+        member.num_failures += 1
+        member.down_until = max(member.down_until, time.monotonic() + self.failure_cooldown)
+        tried.append(member)
+        if len(tried) == len(self.members) or not can_retry():
+          raise
+        if self.logger:
+          self.logger.warning(f"Member {self.members.index(member)} of the endpoint group failed, failing over: {e}")
+      finally:
+        member.outstanding -= 1
+
+  def _pick(self, conversation_id, excluded: List[EndpointGroupMember]) -> EndpointGroupMember:
+    now = time.monotonic()
+    candidates = [member for member in self.members if member not in excluded]
+    up = [member for member in candidates if member.is_up(now)]
+
+    if len(up) == 0:
+      # all down, try the one expected back first rather than failing right away
+      return min(candidates, key=lambda member: (not member.healthy, member.down_until))
+    if self.sticky and conversation_id is not None:
+      preferred = max(up, key=lambda member: EndpointGroup._rendezvous_score(conversation_id, member))
+      least_load = min(member.outstanding/member.weight for member in up)
+      if self.sticky_max_imbalance <= 0 or preferred.outstanding/preferred.weight - least_load < self.sticky_max_imbalance:
+        return preferred
+      # the prompt has to be processed again elsewhere, but a busy member would make the request wait longer
+    if self.balance == 'weighted':
+      return EndpointGroup._pick_weighted(up)
+    return min(up, key=lambda member: ((member.outstanding + 1)/member.weight, member.num_requests/member.weight))
+
+  @staticmethod
+  def _rendezvous_score(conversation_id: str, member: EndpointGroupMember):
+    """
+    Weighted rendezvous hashing: the member with the highest score gets the conversation.
+    A stable hash, unlike `hash`, which differs among processes.
+    """
+    digest = hashlib.blake2b(f"{conversation_id}\0{member.name}".encode('utf-8'), digest_size=8).digest()
+    h = (int.from_bytes(digest, 'big') + 1) / (2**64 + 1)  # in (0, 1)
+    return -member.weight / math.log(h)
+
+  @staticmethod
+  def _pick_weighted(members: List[EndpointGroupMember]):
+    """
+    Smooth weighted round robin, which interleaves the members instead of sending bursts to each.
+    """
+    for member in members:
+      member.current_weight += member.weight
+    best = max(members, key=lambda member: member.current_weight)
+    best.current_weight -= sum(member.weight for member in members)
+    return best
+
+  def _start_health_checks(self):
+    if self.health_check_interval > 0 and (self._health_check_task is None or self._health_check_task.done()):
+      self._health_check_task = asyncio.create_task(self._check_health_periodically())
+
+  async def _check_health_periodically(self):
+    while True:
+      await asyncio.gather(*[self._check_health(member) for member in self.members])
+      await asyncio.sleep(self.health_check_interval)
+
+  async def _check_health(self, member: EndpointGroupMember):
+    try:
+      healthy = await asyncio.wait_for(member.tc.check_health(), self.health_check_timeout)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      if member.healthy and self.logger:
+        self.logger.warning(f"Member {self.members.index(member)} of the endpoint group is down: {e}")
+      member.healthy = False
+      return
+
+    # a member may pass its health checks and still fail its completions, e.g. when rate limited,
+    # it then stays down for `failure_cooldown` anyway
+    if healthy:
+      member.healthy = True
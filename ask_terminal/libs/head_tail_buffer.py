@@ -0,0 +1,47 @@
+class HeadTailBuffer:
+  """
+  Keep the first `head_size` and the last `tail_size` bytes of a stream fed in chunks, so that
+  however long the stream is, the memory held is bounded by their sum plus the size of a chunk.
+  """
+
+  def __init__(self, head_size: int, tail_size: int):
+    self.head_size = head_size
+    self.tail_size = tail_size
+    self.num_bytes = 0  # received so far
+
+    self._head = bytearray()
+    self._tail = bytearray()
+
+  @property
+  def num_dropped(self):
+    return self.num_bytes - len(self._head) - len(self._tail)
+
+  def feed(self, chunk: bytes):
+    self.num_bytes += len(chunk)
+
+    if len(self._head) < self.head_size:
+      room = self.head_size - len(self._head)
+      self._head += chunk[:room]
+      chunk = chunk[room:]
+    if len(chunk) == 0:
+      return
+
+    if len(chunk) >= self.tail_size:
+      self._tail[:] = chunk[len(chunk)-self.tail_size:]
+    else:
+      self._tail += chunk
+      excess = len(self._tail) - self.tail_size
+      if excess > 0:
+        del self._tail[:excess]
+
+  def getvalue(self, truncation_indicator='') -> str:
+    """
+    Returns the text kept, with `truncation_indicator` in place of the bytes dropped in between.
+    A character split by the cut is replaced with U+FFFD.
+    """
+    if self.num_dropped == 0:
+      return (self._head + self._tail).decode('utf-8', errors='replace')
+
+    head = self._head.decode('utf-8', errors='replace')
+    tail = self._tail.decode('utf-8', errors='replace')
+    return head + truncation_indicator + tail
@@ -0,0 +1,96 @@
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from mext import Mext
+from pydantic import BaseModel
+
+
+class IncrementalComposer:
+  """
+  Compose prompts over a growing history while rendering each history item only once.
+
+  The template is rendered with an empty history to get the frame of the prompt, and with
+  a single item to get the text that item inserts into the frame. The text of an item is
+  cached until the item is mutated, so composing a prompt renders a constant amount of
+  template however long the history is, and the prefix made of completed items stays
+  byte-stable across calls.
+
+  This relies on the text of an item not depending on the other items, nor on the parameters
+  that only affect the end of the prompt (such as `gen_role`). Whenever an item does not
+  render as a plain insertion into the frame, the whole prompt is rendered instead.
+  """
+
+  def __init__(self, context_mgr: Mext):
+    self._context_mgr = context_mgr
+    self._header: Optional[str] = None  # the part of the frame before the history
+    self._items: Dict[int, Tuple[BaseModel, tuple, str]] = {}
+
+  @staticmethod
+  def _fingerprint(item: BaseModel):
+    return tuple(getattr(item, name) for name in type(item).model_fields)
+
+  def estimate_memory(self):
+    """
+    Estimated memory held by the cached texts of the items, in bytes.
+    """
+    return sys.getsizeof(self._header or '') + sum(
+      sys.getsizeof(fingerprint) + sys.getsizeof(chunk)
+      for _, fingerprint, chunk in self._items.values()
+    )
+
+  def _reset(self):
+    self._header = None
+    self._items = {}
+
+  def _render_item(self, item: BaseModel, frame: str, params: dict) -> Optional[str]:
+    rendered = self._context_mgr.compose(history=[item], **params)
+
+    if self._header is None:
+      # split the frame as early as the rendered item allows, which keeps the split
+      # out of the end of the frame that changes with parameters like `gen_role`
+      max_suffix = min(len(frame), len(rendered))
+      suffix = 0
+      while suffix < max_suffix and frame[-suffix-1] == rendered[-suffix-1]:
+        suffix += 1
+      self._header = frame[:len(frame)-suffix]
+
+    split = len(self._header)
+    footer = frame[split:]
+    if len(rendered) < len(frame) or not rendered.startswith(self._header) or not rendered.endswith(footer):
+      return None
+
+    return rendered[split:len(rendered)-len(footer)]
+
+  def compose(self, history: List[BaseModel], **params) -> str:
+    return ''.join(self.compose_parts(history, **params))
+
+  def compose_parts(self, history: List[BaseModel], **params) -> List[str]:
+    """
+    Compose the prompt as the list of its parts: the header, the text of each item and the footer,
+    or the whole prompt alone if it had to be rendered at once.
+    """
+    frame = self._context_mgr.compose(history=[], **params)
+    if len(history) == 0:
+      return [frame]
+
+    if self._header is not None and not frame.startswith(self._header):
+      self._reset()  # parameters affecting the header have changed
+
+    items = {}
+    chunks = []
+    for item in history:
+      fingerprint = IncrementalComposer._fingerprint(item)
+      cached = self._items.get(id(item))
+      if cached is not None and cached[0] is item and cached[1] == fingerprint:
+        chunk = cached[2]
+      else:
+        chunk = self._render_item(item, frame, params)
+        if chunk is None:
+          self._reset()
+          return [self._context_mgr.compose(history=history, **params)]
+      items[id(item)] = (item, fingerprint, chunk)
+      chunks.append(chunk)
+    self._items = items
+
+    split = len(self._header)
+    return [frame[:split], *chunks, frame[split:]]
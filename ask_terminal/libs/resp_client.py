@@ -0,0 +1,133 @@
+import asyncio
+from typing import List, Optional
+from urllib.parse import urlparse
+
+
+class RespError(Exception):
+  pass
+
+class RespClient:
+  """
+  Minimal asyncio client of the Redis serialization protocol (RESP2), enough for
+  simple commands against Redis or any server speaking the same protocol.
+  Connections are kept open and reused between commands.
+  """
+
+  def __init__(self, url="redis://127.0.0.1:6379/0", max_idle_connections=8):
+    """
+    Params
+    ======
+    url:
+      redis://[[username]:password@]host[:port][/db]
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('redis', ''):
+      raise ValueError(f"Unsupported url scheme '{parsed.scheme}'")
+
+    self.host = parsed.hostname or '127.0.0.1'
+    self.port = parsed.port or 6379
+    self.username = parsed.username or None
+    self.password = parsed.password or None
+    self.db = int(parsed.path.strip('/') or 0)
+    self.max_idle_connections = max_idle_connections
+
+    self._idle: List[tuple] = []
+
+  async def execute(self, *args):
+    reader, writer = await self._acquire()
+    try:
+      writer.write(RespClient._encode(args))
+      await writer.drain()
+      response = await RespClient._read(reader)
+    except BaseException:
+      writer.close()
+      raise
+
+    self._release(reader, writer)
+    if isinstance(response, RespError):
+      raise response
+    return response
+
+  async def close(self):
+    idle, self._idle = self._idle, []
+    for _, writer in idle:
+      writer.close()
+    for _, writer in idle:
+      try:
+        await writer.wait_closed()
+      except OSError:
+        pass
+
+  async def _acquire(self):
+    while len(self._idle) > 0:
+      reader, writer = self._idle.pop()
+      if not writer.is_closing() and not reader.at_eof():
+        return reader, writer
+      writer.close()
+
+    reader, writer = await asyncio.open_connection(self.host, self.port)
+    try:
+      if self.password is not None:
+        auth = (self.username, self.password) if self.username else (self.password,)
+        await self._handshake(reader, writer, 'AUTH', *auth)
+      if self.db != 0:
+        await self._handshake(reader, writer, 'SELECT', self.db)
+    except BaseException:
+      writer.close()
+      raise
+
+    return reader, writer
+
+  def _release(self, reader, writer):
+    if len(self._idle) < self.max_idle_connections:
+      self._idle.append((reader, writer))
+    else:
+      writer.close()
+
+  @staticmethod
+  async def _handshake(reader, writer, *args):
+    writer.write(RespClient._encode(args))
+    await writer.drain()
+    response = await RespClient._read(reader)
+    if isinstance(response, RespError):
+      raise response
+
+  @staticmethod
+  def _encode(args) -> bytes:
+    chunks = [b'*%d\r\n' % len(args)]
+    for arg in args:
+      if isinstance(arg, bytes):
+        data = arg
+      elif isinstance(arg, str):
+        data = arg.encode('utf-8')
+      else:
+        data = str(arg).encode('utf-8')
+      chunks.append(b'$%d\r\n' % len(data))
+      chunks.append(data)
+      chunks.append(b'\r\n')
+    return b''.join(chunks)
+
+  @staticmethod
+  async def _read(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b'\r\n')
+    kind, payload = line[:1], line[1:-2]
+
+    if kind == b'+':
+      return payload.decode('utf-8')
+    elif kind == b'-':
+      return RespError(payload.decode('utf-8'))
+    elif kind == b':':
+      return int(payload)
+    elif kind == b'$':
+      length = int(payload)
+      if length < 0:
+        return None
+      data = await reader.readexactly(length + 2)
+      return data[:-2]
+    elif kind == b'*':
+      length = int(payload)
+      if length < 0:
+        return None
+      return [await RespClient._read(reader) for _ in range(length)]
+    else:
+      raise RespError(f"Malformed response: {line!r}")
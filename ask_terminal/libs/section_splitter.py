@@ -0,0 +1,54 @@
+from typing import Callable, List, Optional
+
+from ask_terminal.utils import auto_async
+
+
+class SectionSplitter:
+  """
+  Split a streamed completion into two sections at the first occurrence of a marker,
+  forwarding each chunk to the callback of its section as it comes. Text that may be
+  the beginning of a marker split across chunks is held back until it is decided.
+  """
+
+  def __init__(self, marker: str, first_cb: Optional[Callable]=None, second_cb: Optional[Callable]=None):
+    self.marker = marker
+    self.found = False
+    self.sections: List[str] = ['', '']  # text forwarded to each section so far
+
+    self._cbs = [auto_async(first_cb), auto_async(second_cb)]
+    self._pending = ''
+
+  async def __call__(self, content, stop, res=None, **kwargs):
+    content = content or ''
+    if self.found:
+      await self._forward(1, content, stop, res)
+      return
+
+    text = self._pending + content
+    idx = text.find(self.marker)
+    if idx >= 0:
+      self.found = True
+      self._pending = ''
+      await self._forward(0, text[:idx], True, res)
+      await self._forward(1, text[idx+len(self.marker):], stop, res)
+      return
+
+    held = 0 if stop else SectionSplitter._partial_marker_len(text, self.marker)
+    self._pending = text[len(text)-held:] if held > 0 else ''
+    await self._forward(0, text[:len(text)-held], stop, res)
+
+  async def _forward(self, section, content, stop, res):
+    self.sections[section] += content
+    cb = self._cbs[section]
+    if cb is not None and (content or stop):
+      await cb(content=content, stop=stop, res=res)
+
+  @staticmethod
+  def _partial_marker_len(text, marker):
+    """
+    Length of the longest suffix of `text` that is a proper prefix of `marker`.
+    """
+    for length in range(min(len(text), len(marker) - 1), 0, -1):
+      if marker.startswith(text[-length:]):
+        return length
+    return 0
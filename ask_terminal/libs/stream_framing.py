@@ -0,0 +1,132 @@
+from typing import List, NamedTuple, Optional
+
+
+class MalformedFrameError(ValueError):
+  pass
+
+class LineFramer:
+  """
+  Split a byte stream into lines, whatever the chunks it arrives in.
+  Incoming chunks are appended to a single buffer and consumed with a cursor, so every byte
+  is scanned once, and the consumed bytes are only dropped when they make up half of the buffer.
+  """
+
+  def __init__(self, max_line_size=16*1024*1024):
+    self.max_line_size = max_line_size
+
+    self._buffer = bytearray()
+    self._cursor = 0  # start of the pending line
+    self._scanned = 0  # no newline before this offset
+
+  def feed(self, chunk) -> List[bytearray]:
+    """
+    Returns the lines completed by `chunk`, without the terminating `\n`.
+    """
+    buffer = self._buffer
+    buffer += chunk
+
+    lines = []
+    cursor = self._cursor
+    end = buffer.find(b'\n', self._scanned)
+    while end >= 0:
+      lines.append(buffer[cursor:end])
+      cursor = end + 1
+      end = buffer.find(b'\n', cursor)
+
+    if len(buffer) - cursor > self.max_line_size:
+      raise MalformedFrameError(f"Line exceeds {self.max_line_size} bytes")
+
+    if cursor > len(buffer) // 2:
+      del buffer[:cursor]
+      cursor = 0
+    self._cursor = cursor
+    self._scanned = len(buffer)
+
+    return lines
+
+  def pending(self) -> bytes:
+    """
+    Bytes received after the last complete line.
+    """
+    return bytes(self._buffer[self._cursor:])
+
+class SSEEvent(NamedTuple):
+  event: str
+  data: str
+  id: Optional[str] = None
+
+class SSEDecoder:
+  """
+  Decode a stream of Server-Sent Events, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+  Unlike the specification, which ignores them, fields other than `data`, `event`, `id` and `retry`
+  are reported as malformed frames, since that is how some servers report errors mid-stream.
+  """
+
+  def __init__(self, max_line_size=16*1024*1024):
+    self._framer = LineFramer(max_line_size=max_line_size)
+
+    self._event = ''
+    self._data: List[str] = []
+    self._id: Optional[str] = None
+
+  def feed(self, chunk) -> List[SSEEvent]:
+    """
+    Returns the events completed by `chunk`.
+    """
+    events = []
+    for line in self._framer.feed(chunk):
+      event = self._process_line(line)
+      if event is not None:
+        events.append(event)
+    return events
+
+  def close(self) -> List[SSEEvent]:
+    """
+    Returns the last event if the stream ends without the blank line terminating it.
+    """
+    pending = self._framer.pending()
+    if len(pending) > 0:
+      self._process_line(pending)
+    event = self._dispatch()
+    return [event] if event is not None else []
+
+  def _process_line(self, line: bytearray) -> Optional[SSEEvent]:
+    if len(line) > 0 and line[-1] == 0x0d:  # \r\n
+      line = line[:-1]
+
+    if len(line) == 0:
+      return self._dispatch()
+    if line[0] == 0x3a:  # ':', comment
+      return None
+
+    try:
+      line = line.decode('utf-8')
+    except UnicodeDecodeError as e:
+      raise MalformedFrameError(f"Invalid utf-8 in line: {line[:256]!r}") from e
+
+    field, sep, value = line.partition(':')
+    if sep and value.startswith(' '):
+      value = value[1:]
+
+    if field == 'data':
+      self._data.append(value)
+    elif field == 'event':
+      self._event = value
+    elif field == 'id':
+      self._id = value
+    elif field == 'retry':
+      pass
+    else:
+      raise MalformedFrameError(f"Unexpected line: {line[:256]!r}")
+
+    return None
+
+  def _dispatch(self) -> Optional[SSEEvent]:
+    if len(self._data) == 0:
+      self._event = ''
+      return None
+
+    event = SSEEvent(event=self._event or 'message', data='\n'.join(self._data), id=self._id)
+    self._event = ''
+    self._data = []
+    return event
@@ -1,48 +1,506 @@
+import codecs
+import hashlib
 import json
-import aiohttp.http_exceptions
-import openai
-import requests
-import os
-import time
 import logging
 import math
+import random
+import sys
+import threading
+import time
 
 import asyncio
 import aiohttp
+from collections import OrderedDict
+from typing import Dict, List, Optional
 
 from ask_terminal.utils import auto_async
+from .stream_framing import LineFramer, SSEDecoder, MalformedFrameError
+
+
+def decode_json_frame(frame):
+  try:
+    if not isinstance(frame, str):
+      frame = frame.decode('utf-8')  # faster than letting json detect the encoding
+    return json.loads(frame)
+  except ValueError as e:  # also invalid utf-8
+    raise MalformedFrameError(f"Invalid JSON in frame: {frame[:256]!r}") from e
+
+class ClientSessionPool:
+  """
+  Keep one pooled `aiohttp.ClientSession` per server, so that requests (including the
+  many tokenization requests issued while truncating) reuse keep-alive connections
+  instead of opening a new one each time.
+
+  Connection options (the `connection` field of an endpoint in `text_completion_endpoints`)
+  ======
+  limit:
+    maximum number of simultaneous connections, 0 for unlimited
+
+  limit_per_host:
+    maximum number of simultaneous connections to the same host, 0 for unlimited
+
+  keepalive_timeout:
+    seconds to keep an idle connection open for reuse
+
+  connect_timeout / read_timeout / total_timeout:
+    timeouts in seconds, None to disable; only `connect_timeout` applies to `openai` and `anthropic`
+  """
+
+  DEFAULT_LIMIT = 100
+  DEFAULT_LIMIT_PER_HOST = 0
+  DEFAULT_KEEPALIVE_TIMEOUT = 30
+  DEFAULT_CONNECT_TIMEOUT = 10
+
+  def __init__(self):
+    self._sessions: Dict[tuple, aiohttp.ClientSession] = {}
+
+  def get(
+      self, server_url,
+      limit=DEFAULT_LIMIT, limit_per_host=DEFAULT_LIMIT_PER_HOST, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+      connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=None, total_timeout=None,
+    ) -> aiohttp.ClientSession:
+    """
+    Must be called with a running event loop.
+    """
+    key = (server_url, limit, limit_per_host, keepalive_timeout, connect_timeout, read_timeout, total_timeout)
+    session = self._sessions.get(key)
+    if session is None or session.closed:
+      connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+      )
+      timeout = aiohttp.ClientTimeout(
+        total=total_timeout,
+        sock_connect=connect_timeout,
+        sock_read=read_timeout,
+      )
+      session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+      self._sessions[key] = session
+    return session
+
+  def open(self, endpoints_cfg: Dict[str, Dict]):
+    """
+    Create the sessions of all the endpoints served over a `server_url` ahead of time,
+    including the members of the endpoint groups.
+    """
+    for cfg in endpoints_cfg.values():
+      for member_cfg in cfg.get('members', [cfg]):
+        member_cfg = { **cfg, **member_cfg }
+        if 'server_url' in member_cfg:
+          self.get(member_cfg['server_url'], **(member_cfg.get('connection') or {}))
+
+  async def close(self):
+    sessions = list(self._sessions.values())
+    self._sessions.clear()
+    for session in sessions:
+      if not session.closed:
+        await session.close()
+
+client_session_pool = ClientSessionPool()
+
+
+class TokenCountCache:
+  """
+  Bounded memo of the number of tokens of contents, keyed by a hash of the content.
+  The least recently used counts are evicted first.
+  """
+
+  def __init__(self, max_entries=4096):
+    self.max_entries = max_entries
+
+    self._counts: OrderedDict[bytes, int] = OrderedDict()
+    self._num_hits = 0
+    self._num_misses = 0
+
+  @staticmethod
+  def key(content: str) -> bytes:
+    return hashlib.blake2b(content.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+  def get(self, key) -> Optional[int]:
+    count = self._counts.get(key)
+    if count is None:
+      self._num_misses += 1
+      return None
+
+    self._counts.move_to_end(key)
+    self._num_hits += 1
+    return count
+
+  def put(self, key, count: int):
+    self._counts[key] = count
+    self._counts.move_to_end(key)
+    while len(self._counts) > self.max_entries:
+      self._counts.popitem(last=False)
+
+  def stats(self):
+    return {
+      'num_entries': len(self._counts),
+      'hits': self._num_hits,
+      'misses': self._num_misses,
+    }
+
+class CircuitOpenError(RuntimeError):
+  pass
+
+class EndpointTimeoutError(TimeoutError):
+  pass
+
+def is_transient_error(e: Exception):
+  """
+  Whether the error comes from the state of the upstream, so that the same request may succeed
+  later or on another server, unlike errors of the request itself.
+  """
+  status = getattr(e, 'status', None)  # aiohttp
+  if not isinstance(status, int):
+    status = getattr(e, 'status_code', None)  # openai and anthropic
+  if isinstance(status, int):
+    return status >= 500 or status in (408, 429)
+  if isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError, TimeoutError, MalformedFrameError, CircuitOpenError)):
+    return True
+  # the SDKs are optional, an error of one of them means that it has been imported
+  for sdk in ('openai', 'anthropic'):
+    module = sys.modules.get(sdk)
+    if module is not None and isinstance(e, module.APIConnectionError):  # including APITimeoutError
+      return True
+  return False
+
+class RetryBudget:
+  """
+  Allow retries up to `ratio` of the requests, so that retries do not multiply the load of an
+  upstream in trouble. Each request earns `ratio` of a retry, and up to `burst` retries are saved.
+  """
+
+  def __init__(self, ratio=0.2, burst=10):
+    self.ratio = ratio
+    self.burst = burst
+    self._balance = float(burst)
+
+  def deposit(self):
+    self._balance = min(self._balance + self.ratio, self.burst)
+
+  def withdraw(self):
+    if self._balance < 1:
+      return False
+    self._balance -= 1
+    return True
+
+class CircuitBreaker:
+  """
+  Fail fast once an upstream has failed `failure_threshold` times in a row, instead of having
+  every request wait for it to time out. After `recovery_time` seconds, one request at a time
+  is let through to probe it, and the circuit is closed again once one succeeds.
+  """
+
+  def __init__(self, failure_threshold=5, recovery_time=30):
+    self.failure_threshold = failure_threshold
+    self.recovery_time = recovery_time
+
+    self.num_failures = 0  # in a row
+    self._opened_at = None
+    self._probing = False
+
+  @property
+  def state(self):
+    if self._opened_at is None:
+      return 'closed'
+    return 'half_open' if time.monotonic() - self._opened_at >= self.recovery_time else 'open'
+
+  def allow(self):
+    state = self.state
+    if state == 'closed':
+      return True
+    if state == 'half_open' and not self._probing:
+      self._probing = True
+      return True
+    return False
+
+  def record_success(self):
+    self.num_failures = 0
+    self._opened_at = None
+    self._probing = False
+
+  def release(self):
+    """
+    Let another request probe the upstream, when the probe ended without telling its state.
+    """
+    self._probing = False
+
+  def record_failure(self):
+    self.num_failures += 1
+    if self._probing or (self.failure_threshold > 0 and self.num_failures >= self.failure_threshold):
+      self._opened_at = time.monotonic()
+    self._probing = False
+
+  def retry_in(self):
+    if self._opened_at is None:
+      return 0
+    return max(self._opened_at + self.recovery_time - time.monotonic(), 0)
+
+class ResiliencePolicy:
+  """
+  Timeouts, retries and circuit breaking of the completions of an endpoint. A completion is
+  only retried if nothing has been streamed from it yet.
+
+  Resilience options (the `resilience` field of an endpoint in `text_completion_endpoints`)
+  ======
+  first_token_timeout:
+    seconds to wait for the first token, or the whole reply when not streaming; None to disable
+
+  token_timeout:
+    seconds to wait for each of the next tokens; None to disable
+
+  max_retries:
+    maximum number of retries of a completion after transient errors
+
+  backoff_base / backoff_max:
+    retry after a random delay of up to `backoff_base * 2^n` seconds, capped at `backoff_max`
+
+  retry_budget_ratio / retry_budget_burst:
+    see `RetryBudget`
+
+  failure_threshold / recovery_time:
+    see `CircuitBreaker`; a `failure_threshold` of 0 disables the circuit breaker
+  """
+
+  def __init__(
+      self, logger: logging.Logger=None,
+      first_token_timeout: Optional[float]=300, token_timeout: Optional[float]=60,
+      max_retries=2, backoff_base=0.5, backoff_max=8,
+      retry_budget_ratio=0.2, retry_budget_burst=10,
+      failure_threshold=5, recovery_time=30,
+    ):
+    self.logger = logger
+    self.first_token_timeout = first_token_timeout
+    self.token_timeout = token_timeout
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.retry_budget = RetryBudget(retry_budget_ratio, retry_budget_burst)
+    self.circuit_breaker = CircuitBreaker(failure_threshold, recovery_time)
+
+  def stats(self):
+    return {
+      'circuit': self.circuit_breaker.state,
+      'num_failures': self.circuit_breaker.num_failures,
+    }
+
+  async def call(self, request, cb=None):
+    """
+    Run `request(cb)` until it succeeds, fails with an error that is not transient, streams
+    something before failing, or is out of retries.
+    """
+    self.retry_budget.deposit()
+
+    num_retries = 0
+    while True:
+      if not self.circuit_breaker.allow():
+        raise CircuitOpenError(f"Endpoint is failing, requests are rejected for {self.circuit_breaker.retry_in():.1f}s more")
+
+      streamed = False
 
+      async def forward(**kwargs):
+        nonlocal streamed
+        streamed = True
+        if cb is not None:
+          await cb(**kwargs)
+
+      try:
+        res = await self._watch(request, forward, lambda: streamed)
+      except asyncio.CancelledError:
+        self.circuit_breaker.release()
+        raise
+      except Exception as e:
+        if not is_transient_error(e):
+          self.circuit_breaker.release()
+          raise
+        self.circuit_breaker.record_failure()
+        if streamed or num_retries >= self.max_retries or not self.retry_budget.withdraw():
+          raise
+
+        delay = random.uniform(0, min(self.backoff_base * 2**num_retries, self.backoff_max))
+        num_retries += 1
+        if self.logger:
+          self.logger.warning(f"Encounter error, retrying in {delay:.1f}s ({num_retries}/{self.max_retries}): {type(e).__name__}: {e}")
+        await asyncio.sleep(delay)
+        continue
+
+      self.circuit_breaker.record_success()
+      return res
+
+  async def _watch(self, request, cb, streamed):
+    """
+    Run `request(cb)` and cancel it once the tokens it streams to `cb` are late.
+    """
+    if self.first_token_timeout is None and self.token_timeout is None:
+      return await request(cb)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + self.first_token_timeout if self.first_token_timeout is not None else math.inf
+
+    async def watched_cb(**kwargs):
+      nonlocal deadline
+      deadline = loop.time() + self.token_timeout if self.token_timeout is not None else math.inf
+      await cb(**kwargs)
+
+    task = asyncio.ensure_future(request(watched_cb))
+    try:
+      while True:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        done, _ = await asyncio.wait([task], timeout=None if math.isinf(timeout) else timeout)
+        if done:
+          return task.result()
+    finally:
+      if not task.done():
+        task.cancel()  # also drops the connection, so that the server stops generating
+        await asyncio.gather(task, return_exceptions=True)
+
+    waited = self.token_timeout if streamed() else self.first_token_timeout
+    raise EndpointTimeoutError(f"No {'further ' if streamed() else ''}token from the endpoint in {waited}s")
 
 class TextCompletionBase:
-  def __init__(self, *args, **kwargs):
+  def __init__(self, *args, resilience: Optional[Dict]=None, logger: logging.Logger=None, **kwargs):
+    self.token_counts = TokenCountCache()
+    self.resilience = ResiliencePolicy(logger=logger, **(resilience or {}))
+
+  def warm_up(self):
+    """
+    Load heavy resources (e.g. tokenizers) ahead of the first request.
+    May be called from a worker thread.
+    """
+    pass
+
+  def close(self):
+    """
+    Stop the background tasks of the backend, if any.
+    """
     pass
 
+  async def check_health(self):
+    """
+    Whether the upstream is ready to serve, raising if it is not reachable.
+    None if the backend has no cheap way to tell.
+    """
+    return None
+
   async def tokenize(self, content):
     raise NotImplementedError
 
-  async def create(self, *args, **kwargs):
+  async def token_offsets(self, content) -> Optional[List[int]]:
+    """
+    Tokenize `content` once and return the end offset (in characters) of every token,
+    or None if the backend can not provide the offsets.
+    """
+    return None
+
+  async def create(self, *args, cb=None, conversation_id=None, **kwargs):
+    """
+    `conversation_id` identifies the conversation the request belongs to,
+    so that backends can pin upstream resources (e.g. llama.cpp slots) to it.
+    The completion is made by `_create`, under the resilience policy of the endpoint.
+    """
+    async def request(cb):
+      attempt_kwargs = dict(kwargs)
+      if 'params' in attempt_kwargs:
+        attempt_kwargs['params'] = dict(attempt_kwargs['params'])  # backends add their own fields to them
+      return await self._create(*args, cb=cb, conversation_id=conversation_id, **attempt_kwargs)
+
+    return await self.resilience.call(request, cb=auto_async(cb))
+
+  async def _create(self, *args, conversation_id=None, **kwargs):
     raise NotImplementedError
 
+  def release_conversation(self, conversation_id):
+    """
+    Release the upstream resources pinned to a conversation.
+    """
+    pass
+
+  @property
+  def supports_prefill(self):
+    return False
+
+  async def prefill(self, prompt, conversation_id=None):
+    """
+    Process the prompt into the cache of the server without generating anything,
+    so that a later completion extending the prompt starts faster.
+    """
+    pass
+
+  async def num_tokens(self, content):
+    """
+    Number of tokens of `content`, memoized in `token_counts`.
+    """
+    key = TokenCountCache.key(content)
+    count = self.token_counts.get(key)
+    if count is None:
+      count = await self._truncate_count_tokens(content)
+      if not math.isinf(count):
+        self.token_counts.put(key, count)
+    return count
+
   async def _truncate_count_tokens(self, content):
-    return len(await self.tokenize(content))
+    """
+    Number of tokens of `content`, `math.inf` if they can not be counted.
+    """
+    try:
+      return len(await self.tokenize(content))
+    except Exception:
+      return math.inf
 
   async def truncate(self, content, target_num, truncation_indicator, front_ratio=0.5, coarse_gap=0, return_is_truncated=False):
     """
+    Tokenize `content` once and cut the front and rear slices directly in token space.
+    Fall back to a binary search over the character length when the backend can not
+    provide token offsets.
+
     Params
     ======
     front_ratio:
       the ratio of the content to be preserved in the front over the truncated content
 
     coarse_gap:
+      only used by the binary search.
       allowing the final number of tokens to be `coarse_gap` tokens larger or smaller than the `target_num`.
       This could speed up the binary search largely. The speed up ratio can be calculated as `log2(coarse_gap) / log2(original_tokens_count_of_content)`.
     """
 
-    if await self._truncate_count_tokens(content) <= target_num:
-      if return_is_truncated:
-        return content, False
-      else:
-        return content
+    key = TokenCountCache.key(content)
+    num_tokens = self.token_counts.get(key)
+    if num_tokens is not None and num_tokens <= target_num:
+      return (content, False) if return_is_truncated else content
+
+    offsets = await self.token_offsets(content)
+    if offsets is not None:
+      self.token_counts.put(key, len(offsets))
+      res, is_truncated = await self._truncate_by_offsets(content, offsets, target_num, truncation_indicator, front_ratio)
+    else:
+      res, is_truncated = await self._truncate_by_search(content, target_num, truncation_indicator, front_ratio, coarse_gap)
+
+    if return_is_truncated:
+      return res, is_truncated
+    else:
+      return res
+
+  async def _truncate_by_offsets(self, content, offsets, target_num, truncation_indicator, front_ratio):
+    num_tokens = len(offsets)
+    if num_tokens <= target_num:
+      return content, False
+
+    budget = max(target_num - await self.num_tokens(truncation_indicator), 0)
+    num_front = int(budget*front_ratio)
+    num_rear = budget - num_front
+
+    front = offsets[num_front-1] if num_front > 0 else 0
+    rear = offsets[num_tokens-num_rear-1] if num_rear > 0 else len(content)
+
+    return content[:front] + truncation_indicator + content[rear:], True
+
+  async def _truncate_by_search(self, content, target_num, truncation_indicator, front_ratio, coarse_gap):
+    if await self.num_tokens(content) <= target_num:
+      return content, False
 
     if coarse_gap > 0:
       coarse_gap = min(coarse_gap, target_num//2)
@@ -52,7 +510,7 @@ class TextCompletionBase:
       m = (l+r)>>1
       front = int(m*front_ratio)
       rear = m - front
-      num_tokens = await self._truncate_count_tokens(content[:front] + truncation_indicator + content[-rear:])
+      num_tokens = await self.num_tokens(content[:front] + truncation_indicator + content[-rear:])
       if coarse_gap > 0 and abs(num_tokens - target_num) <= coarse_gap:
         l = m
         break
@@ -62,35 +520,155 @@ class TextCompletionBase:
         r = m
     front = int(l*front_ratio)
     rear = l - front
-    res = content[:front] + truncation_indicator + content[-rear:]
 
-    if return_is_truncated:
-      return res, True
+    return content[:front] + truncation_indicator + content[-rear:], True
+
+
+class SlotAllocator:
+  """
+  Pin conversations to the slots of a llama.cpp server, so that each conversation keeps
+  reusing the KV cache of its own slot. When there are more conversations than slots,
+  the slot of the least recently used conversation is handed over.
+  A conversation takes the slot given by the hash of its id when that slot is free, so that
+  the server processes, which allocate the slots each on their own, mostly agree on it.
+  """
+
+  def __init__(self, num_slots):
+    self.num_slots = num_slots
+    self._owners: OrderedDict[str, int] = OrderedDict()
+
+  def acquire(self, owner):
+    if owner in self._owners:
+      self._owners.move_to_end(owner)
+      return self._owners[owner]
+
+    if len(self._owners) < self.num_slots:
+      free = set(range(self.num_slots)) - set(self._owners.values())
+      home = SlotAllocator._home_slot(owner, self.num_slots)
+      slot = home if home in free else min(free)
     else:
-      return res
+      _, slot = self._owners.popitem(last=False)
+    self._owners[owner] = slot
+
+    return slot
+
+  def release(self, owner):
+    self._owners.pop(owner, None)
 
+  @staticmethod
+  def _home_slot(owner, num_slots):
+    digest = hashlib.blake2b(str(owner).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % num_slots
+
+# shared by all the conversations of this process, one per llama.cpp server
+slot_allocators: Dict[str, SlotAllocator] = {}
 
 class LLamaTextCompletion(TextCompletionBase):
-  def __init__(self, server_url, logger=None):
+  def __init__(self, server_url, logger=None, connection: Dict=None, cache_prompt=True, slots: Optional[int]=None, resilience: Dict=None):
+    """
+    Params
+    ======
+    cache_prompt:
+      ask the server to reuse the KV cache of the common prefix with the previous prompt
+
+    slots:
+      number of slots of the server (`--parallel`); if set, each conversation is pinned to a slot
+    """
+    super().__init__(resilience=resilience, logger=logger)
     self.server_url = server_url
     self.logger = logger
+    self.connection_cfg = connection or {}
+    self.cache_prompt = cache_prompt
+
+    self.slots = None
+    if slots is not None:
+      if server_url not in slot_allocators or slot_allocators[server_url].num_slots != slots:
+        slot_allocators[server_url] = SlotAllocator(slots)
+      self.slots = slot_allocators[server_url]
+
+  def _session(self):
+    return client_session_pool.get(self.server_url, **self.connection_cfg)
 
   async def tokenize(self, content):
     data = {
       "content": content,
     }
 
-    async with aiohttp.ClientSession() as session:
-      async with session.post(f"{self.server_url}/tokenize", json=data) as raw_res:
-        raw_res.raise_for_status()
-        res = await raw_res.json(encoding='utf-8')
+    async with self._session().post(f"{self.server_url}/tokenize", json=data) as raw_res:
+      raw_res.raise_for_status()
+      res = await raw_res.json(encoding='utf-8')
+
+      return res['tokens']
+
+  async def token_offsets(self, content):
+    data = {
+      "content": content,
+      "with_pieces": True,
+    }
+
+    async with self._session().post(f"{self.server_url}/tokenize", json=data) as raw_res:
+      raw_res.raise_for_status()
+      res = await raw_res.json(encoding='utf-8')
+
+    # pieces are strings, or lists of bytes when they are not valid utf-8 on their own
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pieces = []
+    for token in res['tokens']:
+      if not isinstance(token, dict):
+        return None  # server does not support `with_pieces`
+      piece = token['piece']
+      pieces.append(decoder.decode(piece.encode('utf-8') if isinstance(piece, str) else bytes(piece)))
+    if pieces:
+      pieces[-1] += decoder.decode(b'', final=True)
+
+    # some tokenizers prepend a space to the first token
+    detokenized = ''.join(pieces)
+    if detokenized == content:
+      shift = 0
+    elif detokenized == ' ' + content:
+      shift = 1
+    else:
+      return None
+
+    offsets = []
+    offset = -shift
+    for piece in pieces:
+      offset += len(piece)
+      offsets.append(max(offset, 0))
+
+    return offsets
+
+  def release_conversation(self, conversation_id):
+    if self.slots is not None:
+      self.slots.release(conversation_id)
 
-        return res['tokens']
+  async def check_health(self):
+    # 503 while the model is loading
+    async with self._session().get(f"{self.server_url}/health") as response:
+      response.raise_for_status()
+    return True
 
-  async def create(
+  @property
+  def supports_prefill(self):
+    return self.cache_prompt
+
+  async def prefill(self, prompt, conversation_id=None):
+    req = {
+      'prompt': prompt,
+      'n_predict': 0,
+      'cache_prompt': True,
+    }
+    if self.slots is not None and conversation_id is not None:
+      req['id_slot'] = self.slots.acquire(conversation_id)
+
+    async with self._session().post(f"{self.server_url}/completion", json=req) as response:
+      response.raise_for_status()
+      await response.read()
+
+  async def _create(
       self,
       prompt=None, params={},
-      cb=None,
+      cb=None, conversation_id=None,
     ):
     cb = auto_async(cb)
 
@@ -98,79 +676,102 @@ class LLamaTextCompletion(TextCompletionBase):
     if prompt is not None:
       req['prompt'] = prompt
     req['stream'] = True
+    req.setdefault('cache_prompt', self.cache_prompt)
+    if self.slots is not None and conversation_id is not None:
+      req.setdefault('id_slot', self.slots.acquire(conversation_id))
 
-    # Creating a streaming connection with a POST request
     reply = ''
-    async with aiohttp.ClientSession() as session:
-      async with session.post(f"{self.server_url}/completion", json=req) as response:
-        response.raise_for_status()
-
-        # Processing streaming data in chunks
-        buffer = b""  # Buffer to accumulate streamed data
-        async for chunk in response.content.iter_chunked(1024):
-          if chunk:
-            buffer += chunk
-            while b'\n' in buffer:
-              raw_res, buffer = buffer.split(b'\n', 1)
-              try:
-                # Attempt to decode JSON from the accumulated buffer
-                res = json.loads(raw_res.decode('utf-8')[6:])
-
-                reply += res['content']
-                if cb is not None:
-                  await cb(content=res['content'], stop=res['stop'], res=res)
-
-                if res['stop']:
-                  break
-              except json.JSONDecodeError:
-                pass  # Incomplete JSON, continue accumulating data
+
+    async def process(event):
+      """
+      Returns whether the event ends the completion.
+      """
+      nonlocal reply
+      res = decode_json_frame(event.data)
+
+      reply += res['content']
+      if cb is not None:
+        await cb(content=res['content'], stop=res['stop'], res=res)
+      return res['stop']
+
+    # Creating a streaming connection with a POST request
+    async with self._session().post(f"{self.server_url}/completion", json=req) as response:
+      response.raise_for_status()
+
+      try:
+        decoder = SSEDecoder()
+        stopped = False
+        async for chunk in response.content.iter_any():
+          for event in decoder.feed(chunk):
+            stopped = await process(event)
+            if stopped:
+              break
+          if stopped:
+            break
+
+        if not stopped:
+          # the last event, if not terminated by a blank line, malformed if truncated
+          for event in decoder.close():
+            await process(event)
+      except asyncio.CancelledError:
+        response.close()  # drop the connection, so that the server stops generating
+        raise
 
     return reply
 
 class OpenAITextCompletion(TextCompletionBase):
   MAX_STOPS = 4
 
-  def __init__(self, model_name, api_key=None, logger: logging.Logger=None, initial_system_msg=None):
-    from transformers import AutoTokenizer
-    from openai import OpenAI
+  def __init__(self, model_name, api_key=None, logger: logging.Logger=None, initial_system_msg=None, connection: Dict=None, resilience: Dict=None):
+    from openai import AsyncOpenAI, Timeout
 
+    super().__init__(resilience=resilience, logger=logger)
     self.model_name = model_name
     self.logger = logger
-    self.tokenizer = AutoTokenizer.from_pretrained('gpt2')
-    self.client = OpenAI(api_key=api_key)
+    connect_timeout = (connection or {}).get('connect_timeout', ClientSessionPool.DEFAULT_CONNECT_TIMEOUT)
+    # retried by the resilience policy, the tokens are timed by it
+    self.client = AsyncOpenAI(api_key=api_key, max_retries=0, timeout=Timeout(None, connect=connect_timeout))
     self.initial_system_msg = initial_system_msg
 
+    self._tokenizer = None
+    self._tokenizer_lock = threading.Lock()
+
+  @property
+  def tokenizer(self):
+    """
+    Loaded on first use, which may block; prefer accessing it from a worker thread.
+    """
+    with self._tokenizer_lock:
+      if self._tokenizer is None:
+        from transformers import AutoTokenizer
+        self._tokenizer = AutoTokenizer.from_pretrained('gpt2')
+      return self._tokenizer
+
+  def warm_up(self):
+    self.tokenizer
+
   async def tokenize(self, content):
     return await asyncio.create_task(
       self._tokenize(content=content)
     )
 
-  async def create(
-      self,
-      messages=None, params={ 'stream': True }, prompt=None,
-      cb=None, max_retries=5,
-    ):
-    return await asyncio.create_task(
-      self._create(
-        messages=messages,
-        params=params, prompt=prompt,
-        cb=cb, max_retries=max_retries,
-      )
-    )
+  async def token_offsets(self, content):
+    return await asyncio.to_thread(self._token_offsets, content)
 
   async def _tokenize(self, content):
-    return self.tokenizer.tokenize(content)
+    return await asyncio.to_thread(lambda: self.tokenizer.tokenize(content))
+
+  def _token_offsets(self, content):
+    if not self.tokenizer.is_fast:
+      return None
+    encoding = self.tokenizer(content, add_special_tokens=False, return_offsets_mapping=True)
+    return [end for _, end in encoding['offset_mapping']]
 
   async def _create(
       self,
       messages=None, params={ 'stream': True }, prompt=None,
-      cb=None, max_retries=5,
+      cb=None, conversation_id=None,
     ):
-    """
-    params
-    -------------
-    max_retries: <= 0 means forever
-    """
     cb = auto_async(cb)
 
     if messages is None:
@@ -184,58 +785,60 @@ class OpenAITextCompletion(TextCompletionBase):
       self.logger.warning(f'OpenAI only supports up to {max_stops}, using only the last few ones.')
 
     reply = ''
-    n_retries = 0
-    while max_retries <= 0 or n_retries < max_retries:
-      n_retries += 1
+    response = await self.client.chat.completions.create(
+      **params,
+      model=self.model_name,
+      messages=messages,
+    )
+    if not params.get('stream', False):
+      reply = response.choices[0].message.content
+      stop = response.choices[0].finish_reason is not None
+      if cb is not None:
+        await cb(content=reply, stop=stop, res=response)
+    else:
       try:
-        response = self.client.chat.completions.create(
-          **params,
-          model=self.model_name,
-          messages=messages,
-        )
-        if not params.get('stream', False):
-          reply = response.choices[0].message.content
-          stop = response.choices[0].finish_reason is not None
+        async for chunk in response:
+          content = chunk.choices[0].delta.content
+          stop = chunk.choices[0].finish_reason is not None
+          if not stop:
+            reply += content
           if cb is not None:
-            await cb(content=reply, stop=stop, res=response)
-        else:
-          for chunk in response:
-            content = chunk.choices[0].delta.content
-            stop = chunk.choices[0].finish_reason is not None
-            if not stop:
-              reply += content
-            if cb is not None:
-              await cb(content=content, stop=stop, res=chunk)
-        break
-      except Exception as e:
-        if n_retries >= max_retries:
-          raise e
-        elif n_retries == 1:
-          if self.logger:
-            if type(e) == openai.RateLimitError:
-              self.logger.warning("Encounter rate limit, retrying.")
-            else:
-              self.logger.warning(f"Encounter unknown error, retrying: {str(e)}")
-        # wait 1 5 13 29 60 120 ...
-        time.sleep(int(4.5*(1.94**n_retries)-3))
+            await cb(content=content, stop=stop, res=chunk)
+      finally:
+        await response.close()  # also stops the generation if cancelled midway
 
     return reply
 
 class AnthropicTokenizer:
+  def __init__(self, api_key=None):
+    from anthropic import Anthropic
+
+    # the tokenizer has been removed from recent versions of the sdk
+    self._client = Anthropic(api_key=api_key) if hasattr(Anthropic, 'get_tokenizer') else None
+
   def tokenize(self, text):
     from langchain_community.utilities.anthropic import get_token_ids_anthropic
     return get_token_ids_anthropic(text)
 
+  def token_offsets(self, text):
+    if self._client is None:
+      return None
+    encoding = self._client.get_tokenizer().encode(text)
+    return [end for _, end in encoding.offsets]
+
 class AnthropicTextCompletion(TextCompletionBase):
   DEFAULT_MAX_TOKENS = 1024
 
-  def __init__(self, model_name, api_key=None, logger=None, initial_system_msg: str=None):
-    from anthropic import Anthropic
+  def __init__(self, model_name, api_key=None, logger=None, initial_system_msg: str=None, connection: Dict=None, resilience: Dict=None):
+    from anthropic import AsyncAnthropic, Timeout
 
+    super().__init__(resilience=resilience, logger=logger)
     self.model_name = model_name
     self.logger = logger
-    self.tokenizer = AnthropicTokenizer()
-    self.client = Anthropic(api_key=api_key)
+    self.tokenizer = AnthropicTokenizer(api_key=api_key)
+    connect_timeout = (connection or {}).get('connect_timeout', ClientSessionPool.DEFAULT_CONNECT_TIMEOUT)
+    # retried by the resilience policy, the tokens are timed by it
+    self.client = AsyncAnthropic(api_key=api_key, max_retries=0, timeout=Timeout(None, connect=connect_timeout))
     self.initial_system_msg = initial_system_msg
 
   async def tokenize(self, content):
@@ -243,14 +846,8 @@ class AnthropicTextCompletion(TextCompletionBase):
       self._tokenize(content=content)
     )
 
-  async def create(
-      self,
-      messages=None, params={}, prompt=None,
-      cb=None,
-    ):
-    return await asyncio.create_task(
-      self._create(messages=messages, params=params, prompt=prompt, cb=cb)
-    )
+  async def token_offsets(self, content):
+    return await asyncio.to_thread(self.tokenizer.token_offsets, content)
 
   async def _tokenize(self, content):
     return self.tokenizer.tokenize(content)
@@ -258,7 +855,7 @@ class AnthropicTextCompletion(TextCompletionBase):
   async def _create(
       self,
       messages=None, params={}, prompt=None,
-      cb=None,
+      cb=None, conversation_id=None,
     ):
     import anthropic
 
@@ -292,7 +889,7 @@ class AnthropicTextCompletion(TextCompletionBase):
       del params['stop']
 
     reply = ''
-    response = self.client.messages.create(
+    response = await self.client.messages.create(
       **params,
       model=self.model_name,
       messages=messages,
@@ -304,23 +901,44 @@ class AnthropicTextCompletion(TextCompletionBase):
       if cb is not None:
         await cb(content=reply, stop=stop, res=response)
     else:
-      raise NotImplementedError
+      try:
+        async for event in response:
+          if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+            content = event.delta.text
+            reply += content
+            if cb is not None:
+              await cb(content=content, stop=False, res=event)
+          elif event.type == 'message_stop':
+            if cb is not None:
+              await cb(content='', stop=True, res=event)
+      finally:
+        await response.close()  # also stops the generation if cancelled midway
 
     return reply
 
 class OllamaTextCompletion(TextCompletionBase):
-  def __init__(self, server_url, model_name, logger: logging.Logger=None):
+  def __init__(self, server_url, model_name, logger: logging.Logger=None, connection: Dict=None, resilience: Dict=None):
+    super().__init__(resilience=resilience, logger=logger)
     self.server_url = server_url
     self.model_name = model_name
     self.logger = logger
+    self.connection_cfg = connection or {}
+
+  def _session(self):
+    return client_session_pool.get(self.server_url, **self.connection_cfg)
 
   async def tokenize(self, content):
     raise NotImplementedError  # too bad ollama doesn't support tokenziation for now
 
-  async def create(
+  async def check_health(self):
+    async with self._session().get(f"{self.server_url}/api/version") as response:
+      response.raise_for_status()
+    return True
+
+  async def _create(
       self,
       prompt, params={},
-      cb=None,
+      cb=None, conversation_id=None,
     ):
     req = {
       'model': self.model_name,
@@ -332,34 +950,46 @@ class OllamaTextCompletion(TextCompletionBase):
     cb = auto_async(cb)
 
     reply = ''
-    async with aiohttp.ClientSession() as session:
-      async with session.post(f"{self.server_url}/api/generate", json=req) as response:
-        response.raise_for_status()
-
-        # Processing streaming data in chunks
-        buffer = b""  # Buffer to accumulate streamed data
-        async for chunk in response.content.iter_chunked(1024):
-          if chunk:
-            buffer += chunk
-            while b'\n' in buffer:
-              raw_res, buffer = buffer.split(b'\n', 1)
-              try:
-                # Attempt to decode JSON from the accumulated buffer
-                res = json.loads(raw_res.decode('utf-8'))
-
-                if 'error' in res:
-                  if self.logger:
-                    self.logger.warning(f"Encounter error: {res['error']}")
-                  raise RuntimeError(f"Error from server: {res['error']}")
-
-                reply += res['response']
-                if cb is not None:
-                  await cb(content=res['response'], stop=res['done'], res=res)
-
-                if res['done']:
-                  break
-              except json.JSONDecodeError:
-                pass  # Incomplete JSON, continue accumulating data
+
+    async def process(line):
+      """
+      Returns whether the line ends the completion.
+      """
+      nonlocal reply
+      if len(line) == 0:
+        return False
+      res = decode_json_frame(line)
+
+      if 'error' in res:
+        if self.logger:
+          self.logger.warning(f"Encounter error: {res['error']}")
+        raise RuntimeError(f"Error from server: {res['error']}")
+
+      reply += res['response']
+      if cb is not None:
+        await cb(content=res['response'], stop=res['done'], res=res)
+      return res['done']
+
+    async with self._session().post(f"{self.server_url}/api/generate", json=req) as response:
+      response.raise_for_status()
+
+      try:
+        framer = LineFramer()
+        stopped = False
+        async for chunk in response.content.iter_any():
+          for line in framer.feed(chunk):
+            stopped = await process(line)
+            if stopped:
+              break
+          if stopped:
+            break
+
+        if not stopped:
+          # the last line, if not terminated by a newline, malformed if truncated
+          await process(framer.pending())
+      except asyncio.CancelledError:
+        response.close()  # drop the connection, so that the server stops generating
+        raise
 
     return reply
 
@@ -370,15 +1000,14 @@ class OllamaTextCompletion(TextCompletionBase):
       'truncate': truncate,
     }
 
-    async with aiohttp.ClientSession() as session:
-      async with session.post(f"{self.server_url}/api/embed", json=data) as raw_res:
-        raw_res.raise_for_status()
-        res = await raw_res.json(encoding='utf-8')
+    async with self._session().post(f"{self.server_url}/api/embed", json=data) as raw_res:
+      raw_res.raise_for_status()
+      res = await raw_res.json(encoding='utf-8')
 
-        if 'error' in res:
-          raise RuntimeError(res['error'])
+      if 'error' in res:
+        raise RuntimeError(res['error'])
 
-        return res.get('prompt_eval_count', 0)
+      return res.get('prompt_eval_count', 0)
 
   async def _truncate_count_tokens(self, content):
     try:
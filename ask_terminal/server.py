@@ -1,4 +1,7 @@
 import argparse
+import json
+import os
+import socket
 import sys
 import logging
 from pathlib import Path
@@ -15,9 +18,63 @@ from .settings import Settings
 _logger = logging.getLogger(__name__)
 
 
-def chat(settings, host, port):
-  set_settings(settings)
-  uvicorn.run(app, host=host, port=port)
+SERVER_ARGS_ENV = 'ASK_TERMINAL_SERVER_ARGS'
+
+
+def chat(settings, host, port, workers=1, uds=None, uds_mode=0o600):
+  listen_args = dict(host=host, port=port)
+  sock = None
+  if uds is not None:
+    sock = bind_unix_socket(uds, uds_mode)
+    listen_args = dict(fd=sock.fileno())
+
+  try:
+    if workers > 1:
+      # each worker process builds the app and loads the settings on its own, see `create_app`
+      uvicorn.run("ask_terminal.server:create_app", factory=True, workers=workers, **listen_args)
+    else:
+      set_settings(settings)
+      uvicorn.run(app, **listen_args)
+  finally:
+    if sock is not None:
+      sock.close()
+      Path(uds).expanduser().unlink(missing_ok=True)
+
+def bind_unix_socket(path: Union[str, Path], mode: int):
+  """
+  Bind a Unix domain socket at `path`, only accessible as allowed by `mode`, so that access to the
+  server is controlled by the file permissions (the `uds` of uvicorn makes it writable by anyone).
+  The file of a socket left over by a server that is gone, e.g. killed by a signal, is replaced.
+  """
+  path = Path(path).expanduser()
+  if path.is_socket():
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+      try:
+        probe.connect(str(path))
+      except ConnectionRefusedError:
+        path.unlink()
+      else:
+        _logger.error(f"Another server is listening on {path}")
+        sys.exit(1)
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # no window in which the socket is accessible with the default permissions
+  umask = os.umask(0o777 & ~mode)
+  try:
+    sock.bind(str(path))
+  finally:
+    os.umask(umask)
+  os.chmod(path, mode)
+  return sock
+
+def create_app():
+  """
+  App factory for the worker processes, configured with the arguments of the main process.
+  """
+  args = parse_arg(json.loads(os.environ[SERVER_ARGS_ENV]))
+  setup(args)
+  set_settings(load_config(args.config))
+  return app
 
 def parse_arg(argv=sys.argv[1:]):
   parser = argparse.ArgumentParser()
@@ -28,6 +85,9 @@ def parse_arg(argv=sys.argv[1:]):
   parser.add_argument('--config', '-c', type=str, default="configs/ask_terminal.yaml")
   parser.add_argument('--host', type=str, default="127.0.0.1")
   parser.add_argument('--port', type=int, default=16099)
+  parser.add_argument('--uds', type=str, default=None, help="serve on a Unix domain socket at this path instead of `--host` and `--port`")
+  parser.add_argument('--uds-mode', type=lambda mode: int(mode, 8), default=0o600, help="permissions of the Unix domain socket, in octal")
+  parser.add_argument('--workers', type=int, default=1, help="number of server processes; requires a `conversation_store` shared by the processes")
   return parser.parse_args(argv)
 
 def load_config(config_file: Union[str, Path]):
@@ -42,9 +102,7 @@ def load_config(config_file: Union[str, Path]):
 
   return configs
 
-def main():
-  args = parse_arg()
-
+def setup(args):
   if args.debug:
     DEBUG_MODE.set(args.debug)
 
@@ -60,8 +118,19 @@ def main():
     additional_log_handlers.append(hfile)
   setup_logging(level=log_level, handlers=additional_log_handlers)
 
+def main():
+  argv = sys.argv[1:]
+  args = parse_arg(argv)
+  setup(args)
+
   settings = load_config(args.config)
-  chat(settings, args.host, args.port)
+  if args.workers > 1:
+    if settings.conversation_store.backend == 'memory':
+      _logger.error("Multiple workers require the conversations to be stored in a shared `conversation_store`, such as `sqlite` or `redis`")
+      sys.exit(1)
+    os.environ[SERVER_ARGS_ENV] = json.dumps(argv)
+
+  chat(settings, args.host, args.port, workers=args.workers, uds=args.uds, uds_mode=args.uds_mode)
 
 if __name__ == "__main__":
   main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional
 
 from pydantic import BaseModel, Field
 
@@ -8,8 +8,14 @@ class SettingsAskTerminal(BaseModel):
   model_name: Optional[str] = Field(None, help="default model name, if the endpoint supports setting model; this will overwrite the endpoint's `model` field in `text_completion_endpoints`")
   prompt: str = Field("prompts/ask-terminal.mext", help="prompt template")
   use_thinking: bool = Field(True, help="think before composing the command or not (chain of thought)")
+  combine_thinking_and_command: bool = Field(False, help="generate the thinking and the command in one completion instead of two; only applies with `use_thinking`")
+  speculative_prefill: bool = Field(False, help="have the endpoint process the prompt of the reply ahead of time while the command is being executed, at the cost of a request per turn; only `local-llama` with `cache_prompt` supports it, set its `slots` too so that the reply lands in the prefilled slot")
   max_observation_tokens: int = Field(1024, help="truncate the output of command to this length before asking for a reply")
+  max_observation_bytes: int = Field(64*1024, help="when the output of command is uploaded raw, only keep this many bytes from its beginning and its end while receiving it, before truncating it to `max_observation_tokens`")
   max_reply_tokens: int = Field(2048, help="the maximum number of tokens to generate for a reply")
+  max_prompt_tokens: int = Field(0, help="token budget of the prompt, the history is compacted to fit it once exceeded; can be set per endpoint with `max_prompt_tokens` in `text_completion_endpoints`; 0 for unlimited")
+  max_history_observation_tokens: int = Field(256, help="when compacting the history, first truncate the observations of the previous turns to this length, then drop the oldest turns")
+  compaction_ratio: float = Field(0.75, help="when compacting the history, drop enough turns to bring the prompt down to this fraction of `max_prompt_tokens`, so that the cached prefix of the prompt stays valid for the next turns")
 
   user: str = Field("User", help="name of the user")
   agent: str = Field("Assistant", help="name of the agent")
@@ -17,6 +23,34 @@ class SettingsAskTerminal(BaseModel):
   class Config:
       protected_namespaces = ()
 
+class SettingsConversationPool(BaseModel):
+  max_conversations: int = Field(1024, help="maximum number of conversations kept in memory, the least recently used ones are evicted first; 0 for unlimited")
+  idle_ttl: float = Field(7*24*3600, help="seconds before an idle conversation is evicted; 0 to disable")
+  max_memory_mb: float = Field(0, help="evict the least recently used conversations when their estimated memory exceeds this many megabytes; 0 for unlimited")
+  max_queued_requests: int = Field(4, help="maximum number of requests waiting for the one in progress on the same conversation, the excess ones are rejected; 0 for unlimited")
+  queue_timeout: float = Field(600, help="seconds a request waits for the ones before it on the same conversation before it is rejected; 0 to wait forever")
+
+class SettingsConversationStore(BaseModel):
+  backend: Literal["memory", "sqlite", "redis"] = Field("memory", help="where conversations are persisted; `memory` keeps them only in the conversation pool, `sqlite` writes them to `path` and `redis` to the server at `url`, so they survive restarts and are shared by server processes")
+  path: str = Field("~/.local/share/ask-terminal/conversations.db", help="path of the database for the `sqlite` backend")
+  url: str = Field("redis://127.0.0.1:6379/0", help="url of the server for the `redis` backend, any server speaking the Redis protocol works")
+  retention: float = Field(30*24*3600, help="seconds before a persisted conversation that is no longer updated is deleted; 0 to keep forever")
+  lock_timeout: float = Field(600, help="seconds before the lock of a conversation is considered abandoned by a crashed server process; renewed every third of it while held")
+
+class SettingsCompletionCache(BaseModel):
+  enabled: bool = Field(False, help="reuse the thinking and the command generated for the same first query in the same environment, with the same endpoint, model and parameters")
+  max_entries: int = Field(1024, help="maximum number of cached completions, the least recently used ones are evicted first, the oldest ones from the database; 0 for unlimited")
+  ttl: float = Field(24*3600, help="seconds before a cached completion expires; 0 to never expire")
+  path: Optional[str] = Field(None, help="path of a database to persist the cached completions to, e.g. `~/.cache/ask-terminal/completions.db`; kept in memory only if not set")
+
+class SettingsStreaming(BaseModel):
+  flush_bytes: int = Field(256, help="send the streamed tokens to the client once this many characters are pending; 0 to send every token as it comes")
+  flush_interval: float = Field(0.03, help="seconds the streamed tokens may be held back to be sent together; 0 to only send them together when they arrive together")
+
 class Settings(BaseModel):
   ask_terminal: SettingsAskTerminal = SettingsAskTerminal()
+  conversation_pool: SettingsConversationPool = SettingsConversationPool()
+  conversation_store: SettingsConversationStore = SettingsConversationStore()
+  completion_cache: SettingsCompletionCache = SettingsCompletionCache()
+  streaming: SettingsStreaming = SettingsStreaming()
   text_completion_endpoints: Dict[str, Dict] = {}
@@ -1,4 +1,4 @@
-from .configs import APP_ROOT, search_config_file
+from .configs import APP_ROOT, search_config_file, load_credentials
 from .logging import LOG_HEAVY, LOG_VERBOSE, setup_logging
 from .debug_mode import DEBUG_MODE
 from .misc import auto_async
\ No newline at end of file
@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
 
+from functools import lru_cache
 from pathlib import Path
 from typing import Union
 
+import yaml
+
 APP_ROOT = Path(__file__).parent.parent
 CONFIGS_SEARCH_DIRS = [
   Path.home() / '.config' / 'ask-terminal',
   APP_ROOT,
 ]
 
+@lru_cache(maxsize=None)
 def search_config_file(filename: Union[str, Path]):
   for dir in CONFIGS_SEARCH_DIRS:
     path = dir / filename
     if path.exists():
       return path
   raise FileNotFoundError(f'File "{filename}" not found')
+
+@lru_cache(maxsize=None)
+def load_credentials(filename: Union[str, Path]):
+  with open(search_config_file(filename), 'r') as f:
+    return yaml.safe_load(f) or {}
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Fire concurrent streaming requests at the OpenAI backend, served by a local fake
+OpenAI-compatible server, and check that they overlap instead of being serialized.
+
+Usage: python benchmarks/concurrent_requests.py [--num-requests 8] [--num-chunks 10] [--chunk-delay 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+async def fake_chat_completions(request: web.Request):
+  num_chunks = request.app['num_chunks']
+  chunk_delay = request.app['chunk_delay']
+
+  response = web.StreamResponse(headers={ 'Content-Type': 'text/event-stream' })
+  await response.prepare(request)
+  for i in range(num_chunks+1):
+    await asyncio.sleep(chunk_delay)
+    finished = i == num_chunks
+    chunk = {
+      'id': 'chatcmpl-fake',
+      'object': 'chat.completion.chunk',
+      'created': int(time.time()),
+      'model': 'fake',
+      'choices': [{
+        'index': 0,
+        'delta': {} if finished else { 'content': f'{i} ' },
+        'finish_reason': 'stop' if finished else None,
+      }],
+    }
+    await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+  await response.write(b'data: [DONE]\n\n')
+  return response
+
+async def start_fake_server(num_chunks, chunk_delay):
+  app = web.Application()
+  app['num_chunks'] = num_chunks
+  app['chunk_delay'] = chunk_delay
+  app.router.add_post('/v1/chat/completions', fake_chat_completions)
+
+  runner = web.AppRunner(app)
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  port = site._server.sockets[0].getsockname()[1]
+  return runner, f'http://127.0.0.1:{port}/v1'
+
+async def main(args):
+  runner, base_url = await start_fake_server(args.num_chunks, args.chunk_delay)
+  os.environ['OPENAI_BASE_URL'] = base_url
+
+  from ask_terminal.libs.text_completion_endpoint import OpenAITextCompletion
+  tc = OpenAITextCompletion(model_name='fake', api_key='fake')
+
+  async def timed_request():
+    start = time.perf_counter()
+    await tc.create(prompt='hello', params={ 'stream': True })
+    return time.perf_counter() - start
+
+  try:
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[timed_request() for _ in range(args.num_requests)])
+    elapsed = time.perf_counter() - start
+  finally:
+    await runner.cleanup()
+
+  print(f'requests:              {args.num_requests}')
+  print(f'mean request latency:  {sum(latencies)/len(latencies):.3f}s')
+  print(f'sum of latencies:      {sum(latencies):.3f}s')
+  print(f'wall time:             {elapsed:.3f}s')
+  print(f'overlap:               {"yes" if elapsed < 0.5*sum(latencies) else "no"}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num-requests', type=int, default=8)
+  parser.add_argument('--num-chunks', type=int, default=10)
+  parser.add_argument('--chunk-delay', type=float, default=0.05)
+  asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Report the cold start cost of ask-terminal-server: the time to import the server module,
+the time until the server accepts requests, and the latency of the first requests.
+
+Usage: python benchmarks/startup.py [--config configs/ask_terminal.yaml] [--endpoint local-llama] [--runs 3]
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).parent.parent
+
+
+def time_import(module, runs):
+  code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+  results = []
+  for _ in range(runs):
+    out = subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    results.append(float(out.stdout.strip()))
+  return min(results)
+
+def get_free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def post(url, data):
+  req = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'), headers={ 'Content-Type': 'application/json' })
+  with urllib.request.urlopen(req) as res:
+    return json.loads(res.read())
+
+def time_server(config, endpoint, timeout=60):
+  port = get_free_port()
+  base_url = f'http://127.0.0.1:{port}'
+  cmd = [sys.executable, '-m', 'ask_terminal.server', '--config', str(Path(config).absolute()), '--port', str(port)]
+
+  start = time.perf_counter()
+  server = subprocess.Popen(cmd, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while True:
+      if time.perf_counter() - start > timeout:
+        raise TimeoutError('server did not start in time')
+      if server.poll() is not None:
+        raise RuntimeError('server exited unexpectedly')
+      try:
+        urllib.request.urlopen(f'{base_url}/stats')
+        break
+      except urllib.error.URLError:
+        time.sleep(0.01)
+    ready = time.perf_counter() - start
+
+    init_cfg = { 'endpoint': endpoint } if endpoint else {}
+    latencies = []
+    for _ in range(3):
+      t = time.perf_counter()
+      res = post(f'{base_url}/chat/{uuid.uuid4()}/init', init_cfg)
+      latencies.append(time.perf_counter() - t)
+      if res.get('status') != 'success':
+        raise RuntimeError(f'failed to initialize conversation: {res}')
+  finally:
+    server.terminate()
+    server.wait()
+
+  return ready, latencies
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--config', type=str, default=str(REPO_ROOT / 'configs' / 'ask_terminal.yaml'))
+  parser.add_argument('--endpoint', type=str, default=None, help="endpoint to initialize conversations with, default is what specified in the config file")
+  parser.add_argument('--runs', type=int, default=3)
+  args = parser.parse_args()
+
+  print(f'import ask_terminal.server:  {time_import("ask_terminal.server", args.runs)*1000:.1f}ms')
+  ready, latencies = time_server(args.config, args.endpoint)
+  print(f'server ready:                {ready*1000:.1f}ms')
+  print(f'first /init:                 {latencies[0]*1000:.1f}ms')
+  print(f'following /init:             {min(latencies[1:])*1000:.1f}ms')
+
+if __name__ == '__main__':
+  main()
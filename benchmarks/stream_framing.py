@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Compare the stream parsers of the llama.cpp and Ollama endpoints with the previous
+`buffer += chunk; buffer.split(b'\\n', 1)` loop, over recorded streams replayed in chunks
+of various sizes, from small network reads to a whole response arriving in one burst.
+
+Usage: python benchmarks/stream_framing.py [--tokens 4000] [--runs 5] [--recording llama.sse]
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from ask_terminal.libs.stream_framing import LineFramer, SSEDecoder
+
+
+def record_llama(num_tokens):
+  events = [
+    b'data: ' + json.dumps({ 'content': f' token{i}', 'stop': False }).encode('utf-8') + b'\n\n'
+    for i in range(num_tokens)
+  ]
+  events.append(b'data: ' + json.dumps({ 'content': '', 'stop': True, 'timings': { 'predicted_n': num_tokens } }).encode('utf-8') + b'\n\n')
+  return b''.join(events)
+
+def record_ollama(num_tokens):
+  lines = [
+    json.dumps({ 'model': 'm', 'response': f' token{i}', 'done': False }).encode('utf-8') + b'\n'
+    for i in range(num_tokens)
+  ]
+  lines.append(json.dumps({ 'model': 'm', 'response': '', 'done': True }).encode('utf-8') + b'\n')
+  return b''.join(lines)
+
+def split_chunks(data, chunk_size):
+  return [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+
+def legacy_llama(chunks):
+  reply = ''
+  buffer = b""
+  for chunk in chunks:
+    if chunk:
+      buffer += chunk
+      while b'\n' in buffer:
+        raw_res, buffer = buffer.split(b'\n', 1)
+        try:
+          res = json.loads(raw_res.decode('utf-8')[6:])
+          reply += res['content']
+          if res['stop']:
+            break
+        except json.JSONDecodeError:
+          pass
+  return reply
+
+def framed_llama(chunks):
+  reply = ''
+  decoder = SSEDecoder()
+  for chunk in chunks:
+    for event in decoder.feed(chunk):
+      res = json.loads(event.data)
+      reply += res['content']
+      if res['stop']:
+        break
+  return reply
+
+def legacy_ollama(chunks):
+  reply = ''
+  buffer = b""
+  for chunk in chunks:
+    if chunk:
+      buffer += chunk
+      while b'\n' in buffer:
+        raw_res, buffer = buffer.split(b'\n', 1)
+        try:
+          res = json.loads(raw_res.decode('utf-8'))
+          reply += res['response']
+          if res['done']:
+            break
+        except json.JSONDecodeError:
+          pass
+  return reply
+
+def framed_ollama(chunks):
+  reply = ''
+  framer = LineFramer()
+  for chunk in chunks:
+    for line in framer.feed(chunk):
+      if len(line) == 0:
+        continue
+      res = json.loads(line.decode('utf-8'))
+      reply += res['response']
+      if res['done']:
+        break
+  return reply
+
+def best_of(func, chunks, runs):
+  results = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    reply = func(chunks)
+    results.append(time.perf_counter() - start)
+  return min(results), reply
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tokens', type=int, default=4000, help="number of tokens in the synthetic recordings")
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--recording', type=str, action='append', default=[], help="recorded response body to replay, `.sse` for llama.cpp, otherwise Ollama")
+  args = parser.parse_args()
+
+  recordings = [
+    ('llama', 'synthetic', record_llama(args.tokens)),
+    ('ollama', 'synthetic', record_ollama(args.tokens)),
+  ]
+  for path in args.recording:
+    recordings.append(('llama' if path.endswith('.sse') else 'ollama', Path(path).name, Path(path).read_bytes()))
+
+  parsers = {
+    'llama': (legacy_llama, framed_llama),
+    'ollama': (legacy_ollama, framed_ollama),
+  }
+
+  print(f"{'endpoint':<8} {'recording':<16} {'chunk':>10} {'legacy ms':>10} {'framed ms':>10} {'speedup':>8}")
+  for endpoint, name, data in recordings:
+    legacy, framed = parsers[endpoint]
+    for chunk_size in (64, 1024, 16*1024, len(data)):
+      chunks = split_chunks(data, chunk_size)
+      legacy_time, legacy_reply = best_of(legacy, chunks, args.runs)
+      framed_time, framed_reply = best_of(framed, chunks, args.runs)
+      assert legacy_reply == framed_reply, "parsers disagree"
+
+      chunk_name = 'burst' if chunk_size == len(data) else str(chunk_size)
+      print(f"{endpoint:<8} {name:<16} {chunk_name:>10} {legacy_time*1000:>10.2f} {framed_time*1000:>10.2f} {legacy_time/framed_time:>7.1f}x")
+
+if __name__ == '__main__':
+  main()
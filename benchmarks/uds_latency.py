@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Compare the per-request latency of ask-terminal-server on TCP loopback and on a Unix domain
+socket (`--uds`), with a connection kept alive, a new connection per request, and a `curl`
+process per request as the shell client does.
+
+Usage: python benchmarks/uds_latency.py [--config configs/ask_terminal.yaml] [--requests 500]
+"""
+
+import argparse
+import http.client
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).parent.parent
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, path, timeout=10):
+    super().__init__('localhost', timeout=timeout)
+    self.path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.path)
+
+def get_free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_server(config, listen_args, connect, timeout=60):
+  cmd = [sys.executable, '-m', 'ask_terminal.server', '--config', str(Path(config).absolute()), *listen_args]
+  server = subprocess.Popen(cmd, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  start = time.perf_counter()
+  while True:
+    if time.perf_counter() - start > timeout:
+      server.terminate()
+      raise TimeoutError('server did not start in time')
+    if server.poll() is not None:
+      raise RuntimeError('server exited unexpectedly')
+    try:
+      get(connect())
+      return server
+    except OSError:
+      time.sleep(0.01)
+
+def get(conn, path='/stats'):
+  conn.request('GET', path)
+  res = conn.getresponse()
+  res.read()
+  if res.status != 200:
+    raise RuntimeError(f'unexpected status {res.status}')
+
+def time_requests(num_requests, request):
+  latencies = []
+  for _ in range(num_requests):
+    t = time.perf_counter()
+    request()
+    latencies.append(time.perf_counter() - t)
+  return latencies
+
+def measure(num_requests, connect, curl_args):
+  conn = connect()
+  get(conn)  # warm up
+  keep_alive = time_requests(num_requests, lambda: get(conn))
+  conn.close()
+
+  def new_connection():
+    conn = connect()
+    get(conn)
+    conn.close()
+  per_connection = time_requests(num_requests, new_connection)
+
+  per_curl = None
+  if shutil.which('curl') is not None:
+    per_curl = time_requests(max(num_requests//10, 1), lambda: subprocess.run(['curl', '-s', '-o', '/dev/null', *curl_args], check=True))
+
+  return keep_alive, per_connection, per_curl
+
+def report(name, latencies):
+  if latencies is None:
+    print(f'  {name:<16} curl not found')
+    return
+  latencies = sorted(latencies)
+  p99 = latencies[min(int(len(latencies)*0.99), len(latencies)-1)]
+  print(f'  {name:<16} mean {statistics.mean(latencies)*1e6:8.1f}us   p50 {statistics.median(latencies)*1e6:8.1f}us   p99 {p99*1e6:8.1f}us')
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--config', type=str, default=str(REPO_ROOT / 'configs' / 'ask_terminal.yaml'))
+  parser.add_argument('--requests', type=int, default=500)
+  args = parser.parse_args()
+
+  port = get_free_port()
+  uds = Path(tempfile.mkdtemp(prefix='ask-terminal-bench-')) / 'server.sock'
+  transports = [
+    ('tcp loopback', ['--port', str(port)], lambda: http.client.HTTPConnection('127.0.0.1', port, timeout=10), [f'http://127.0.0.1:{port}/stats']),
+    ('unix socket', ['--uds', str(uds)], lambda: UnixHTTPConnection(str(uds)), ['--unix-socket', str(uds), 'http://localhost/stats']),
+  ]
+
+  for name, listen_args, connect, curl_args in transports:
+    server = start_server(args.config, listen_args, connect)
+    try:
+      keep_alive, per_connection, per_curl = measure(args.requests, connect, curl_args)
+    finally:
+      server.terminate()
+      server.wait()
+
+    print(f'{name}:')
+    report('keep-alive', keep_alive)
+    report('new connection', per_connection)
+    report('curl', per_curl)
+
+  shutil.rmtree(uds.parent)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Helper of the shell client, started once per shell session, so that the shell does not spawn
+`curl`, `jq` and `python3` for every request. It keeps a WebSocket connection to the server for
+the current conversation, encodes the requests to JSON, decodes the streamed responses into
+lines the shell can split with `read`, and detects the environment once.
+Only the standard library is used.
+
+Requests are read from stdin as NUL-terminated fields, which cannot appear in shell variables:
+the type of the request (those of `/chat/{conversation_id}/ws`, or `cancel` to cancel the request
+in progress), then `key=value` fields, and an empty field to end the request, e.g.
+
+  printf '%s\0' query_command id=1 conversation_id=... message="$query" stream=true ''
+
+`query_reply` takes the path of the output of the command as `observation_file`, uploaded as is.
+The environment is added to the queries unless given. The messages answering a request are
+written to stdout, one per line, between the lines `%begin <id>` and `%end <id>`. The messages
+of a streamed request are decoded into fields separated by US (\x1f), with the newlines of the
+content replaced by RS (\x1e):
+
+  %frame US null US <section> US <true|false> US <content>
+  %result US <error as JSON, or null> US US US <response as JSON>
+
+Other responses are written as JSON.
+
+Usage: ask-terminal-client.py [--shell SHELL_NAME] [--unix-socket PATH] <server_url>
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import queue
+import socket
+import ssl
+import struct
+import sys
+import threading
+from urllib.parse import urlsplit
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+OBSERVATION_CHUNK_SIZE = 64*1024
+
+FIELD_SEPARATOR = '\x1f'
+NEWLINE_REPLACEMENT = '\x1e'
+BOOLEAN_FIELDS = ('stream', 'command_executed')
+
+
+class ConnectionClosed(Exception):
+  pass
+
+class WebSocketConnection:
+  """
+  Client side of a WebSocket connection, see https://www.rfc-editor.org/rfc/rfc6455
+  Frames are read by a background thread, which answers pings and queues the messages.
+  """
+
+  def __init__(self, url, unix_socket=None, timeout=10):
+    parts = urlsplit(url)
+    secure = parts.scheme in ('https', 'wss')
+    port = parts.port or (443 if secure else 80)
+
+    if unix_socket:
+      # the host of the url is only sent in the headers
+      self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self._sock.settimeout(timeout)
+      try:
+        self._sock.connect(unix_socket)
+      except OSError:
+        self._sock.close()
+        raise
+    else:
+      self._sock = socket.create_connection((parts.hostname, port), timeout=timeout)
+      self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      if secure:
+        self._sock = ssl.create_default_context().wrap_socket(self._sock, server_hostname=parts.hostname)
+    self._file = self._sock.makefile('rb')
+
+    self._handshake(parts.netloc, parts.path + (f"?{parts.query}" if parts.query else ""))
+    self._sock.settimeout(None)
+
+    self.closed = False
+    self.messages = queue.Queue()
+    self._send_lock = threading.Lock()
+    self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+    self._receiver.start()
+
+  def _handshake(self, host, path):
+    key = base64.b64encode(os.urandom(16))
+    request = (
+      f"GET {path} HTTP/1.1\r\n"
+      f"Host: {host}\r\n"
+      "Upgrade: websocket\r\n"
+      "Connection: Upgrade\r\n"
+      f"Sec-WebSocket-Key: {key.decode()}\r\n"
+      "Sec-WebSocket-Version: 13\r\n"
+      "\r\n"
+    )
+    self._sock.sendall(request.encode('ascii'))
+
+    status = self._file.readline().decode('latin-1')
+    headers = {}
+    while True:
+      line = self._file.readline().decode('latin-1').strip()
+      if not line:
+        break
+      name, _, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+
+    if status.split(' ', 2)[1:2] != ['101']:
+      raise ConnectionError(f"WebSocket handshake refused: {status.strip()}")
+    accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode()
+    if headers.get('sec-websocket-accept') != accept:
+      raise ConnectionError("WebSocket handshake failed: invalid accept key")
+
+  def send_text(self, text):
+    self._send_frame(OPCODE_TEXT, text.encode('utf-8'))
+
+  def send_binary(self, data):
+    self._send_frame(OPCODE_BINARY, data)
+
+  def close(self):
+    if not self.closed:
+      try:
+        self._send_frame(OPCODE_CLOSE, struct.pack('!H', 1000))
+      except OSError:
+        pass
+    self.closed = True
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self._sock.close()
+
+  def _send_frame(self, opcode, payload):
+    length = len(payload)
+    if length < 126:
+      header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length < 1<<16:
+      header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+      header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+
+    # frames from the client are masked
+    mask = os.urandom(4)
+    if length > 0:
+      repeated = (mask * (length//4 + 1))[:length]
+      payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+
+    with self._send_lock:
+      if self.closed:
+        raise ConnectionClosed()
+      self._sock.sendall(header + mask + payload)
+
+  def _read_exactly(self, size):
+    data = self._file.read(size)
+    if len(data) < size:
+      raise ConnectionClosed()
+    return data
+
+  def _read_frame(self):
+    first, second = self._read_exactly(2)
+    fin, opcode = first & 0x80, first & 0x0f
+    length = second & 0x7f
+    if length == 126:
+      length, = struct.unpack('!H', self._read_exactly(2))
+    elif length == 127:
+      length, = struct.unpack('!Q', self._read_exactly(8))
+    mask = self._read_exactly(4) if second & 0x80 else None
+
+    payload = self._read_exactly(length)
+    if mask is not None:
+      repeated = (mask * (length//4 + 1))[:length]
+      payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+    return fin, opcode, payload
+
+  def _receive_loop(self):
+    fragments = []
+    message_opcode = None
+    try:
+      while True:
+        fin, opcode, payload = self._read_frame()
+        if opcode == OPCODE_PING:
+          self._send_frame(OPCODE_PONG, payload)
+          continue
+        if opcode == OPCODE_PONG:
+          continue
+        if opcode == OPCODE_CLOSE:
+          break
+
+        if opcode != OPCODE_CONTINUATION:
+          message_opcode = opcode
+        fragments.append(payload)
+        if fin:
+          message = b''.join(fragments)
+          fragments = []
+          self.messages.put(message.decode('utf-8') if message_opcode == OPCODE_TEXT else message)
+    except (OSError, ConnectionClosed, ValueError):
+      pass
+    finally:
+      self.closed = True
+      self.messages.put(None)
+
+def detect_os():
+  """
+  Same as `_get_os_version` of the shell client.
+  """
+  try:
+    with open('/etc/os-release') as f:
+      release = dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+    name = ' '.join(release.get(key, '').strip('"') for key in ('NAME', 'VERSION'))
+    return ' '.join(name.split())
+  except OSError:
+    pass
+
+  if platform.system() == 'Darwin':
+    return f"macOS {platform.mac_ver()[0]}"
+  if platform.system() in ('FreeBSD', 'SunOS'):
+    return f"{platform.system()} {platform.release()} {platform.machine()}"
+  return "Unix"
+
+def read_requests(stream):
+  """
+  Yield the requests read from `stream`, as lists of fields.
+  """
+  fields = []
+  pending = b''
+  while True:
+    chunk = stream.read1(64*1024)
+    if not chunk:
+      break
+
+    *completed, pending = (pending + chunk).split(b'\0')
+    for field in completed:
+      if field:
+        fields.append(field.decode('utf-8', errors='replace'))
+      elif fields:
+        yield fields
+        fields = []
+
+class Client:
+  def __init__(self, server_url, shell_name=None, unix_socket=None):
+    self.unix_socket = unix_socket
+    parts = urlsplit(server_url)
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    self.base_url = f"{scheme}://{parts.netloc}{parts.path.rstrip('/')}"
+
+    shell_name = os.path.basename(shell_name or '').lstrip('-')
+    self.env = {
+      'os': detect_os(),
+      'shell': shell_name if shell_name in ('bash', 'zsh') else None,
+    }
+
+    self._connection = None
+    self._conversation_id = None
+    self._requests = queue.Queue()
+    self._serving = threading.Event()
+
+  def run(self):
+    worker = threading.Thread(target=self._serve_requests, daemon=True)
+    worker.start()
+
+    for fields in read_requests(sys.stdin.buffer):
+      request_type, *fields = fields
+      if request_type == 'cancel':
+        self._cancel()
+        continue
+
+      request = { 'type': request_type }
+      for field in fields:
+        key, _, value = field.partition('=')
+        request[key] = value == 'true' if key in BOOLEAN_FIELDS else value
+      self._requests.put(request)
+
+    self._requests.put(None)
+    worker.join()
+    if self._connection is not None:
+      self._connection.close()
+
+  def _cancel(self):
+    connection = self._connection
+    if self._serving.is_set() and connection is not None:
+      try:
+        connection.send_text(json.dumps({ 'type': 'cancel' }))
+      except (OSError, ConnectionClosed):
+        pass
+
+  def _connect(self, conversation_id):
+    if self._connection is not None and (self._connection.closed or conversation_id != self._conversation_id):
+      self._connection.close()
+      self._connection = None
+
+    if self._connection is None:
+      self._connection = WebSocketConnection(f"{self.base_url}/chat/{conversation_id}/ws", unix_socket=self.unix_socket)
+      self._conversation_id = conversation_id
+    return self._connection
+
+  def _serve_requests(self):
+    while True:
+      request = self._requests.get()
+      if request is None:
+        break
+
+      request_id = request.pop('id', '')
+      print(f"%begin {request_id}", flush=True)
+      self._serving.set()
+      try:
+        self._serve(request)
+      except (OSError, ConnectionClosed) as e:
+        if self._connection is not None:
+          self._connection.close()
+        not_online = isinstance(e, (ConnectionRefusedError, FileNotFoundError))
+        error = "server not online" if not_online else f"connection lost: {e}"
+        self._write_response({ 'status': 'error', 'error': error }, request.get('stream', False))
+      finally:
+        self._serving.clear()
+      print(f"%end {request_id}", flush=True)
+
+  def _serve(self, request):
+    connection = self._connect(request.pop('conversation_id', ''))
+
+    observation_file = request.pop('observation_file', None)
+    if observation_file is not None:
+      request['type'] += '_raw'
+    if request['type'].startswith('query_'):
+      request.setdefault('env', self.env)
+    stream = request.get('stream', False)
+
+    connection.send_text(json.dumps(request))
+    if observation_file is not None:
+      with open(observation_file, 'rb') as f:
+        while True:
+          chunk = f.read(OBSERVATION_CHUNK_SIZE)
+          if not chunk:
+            break
+          connection.send_binary(chunk)
+      connection.send_binary(b'')
+
+    while True:
+      message = connection.messages.get()
+      if message is None:
+        raise ConnectionClosed("closed by the server")
+      if isinstance(message, bytes):
+        continue
+
+      response = json.loads(message)
+      self._write_response(response, stream)
+      if 'status' in response:
+        break
+
+  @staticmethod
+  def _write_response(response, stream):
+    if not stream:
+      print(json.dumps(response, ensure_ascii=False), flush=True)
+      return
+
+    if 'status' in response:
+      fields = ['%result', json.dumps(response.get('error', None), ensure_ascii=False), '', '', json.dumps(response, ensure_ascii=False)]
+    else:
+      content = response.get('content', '').replace(FIELD_SEPARATOR, ' ').replace(NEWLINE_REPLACEMENT, ' ')
+      fields = ['%frame', 'null', response.get('section', ''), 'true' if response.get('finished', False) else 'false', content.replace('\n', NEWLINE_REPLACEMENT)]
+    print(FIELD_SEPARATOR.join(fields), flush=True)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shell', type=str, default=None, help="name of the shell, reported to the server")
+  parser.add_argument('--unix-socket', type=str, default=None, help="connect to the server on this Unix domain socket")
+  parser.add_argument('server_url')
+  args = parser.parse_args()
+
+  try:
+    Client(args.server_url, shell_name=args.shell, unix_socket=args.unix_socket).run()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -3,6 +3,7 @@
 # environment variables
 
 ASK_TERMINAL_SERVER_URL=${ASK_TERMINAL_SERVER_URL:-"http://localhost:16099"}  # url of the ask-terminal-server
+ASK_TERMINAL_SERVER_SOCKET=${ASK_TERMINAL_SERVER_SOCKET:-}  # path of the Unix domain socket of the server started with `--uds`; the host of ASK_TERMINAL_SERVER_URL is then ignored
 ASK_TERMINAL_ENDPOINT=${ASK_TERMINAL_ENDPOINT:-}  # text completion endpoint, default is what specified in the server config file
 ASK_TERMINAL_MODEL=${ASK_TERMINAL_MODEL:-}  # text completion model if the endpoint supports setting the model, default is what specified in the server config file
 ASK_TERMINAL_USE_BLACKLIST=${ASK_TERMINAL_USE_BLACKLIST:-false}  # use blacklist for command, true to execute command by default except those matching ASK_TERMINAL_BLACKLIST_PATTERN
@@ -12,16 +13,32 @@ ASK_TERMINAL_USE_STREAMING=${ASK_TERMINAL_USE_STREAMING:-true}  # stream the out
 ASK_TERMINAL_USE_CLARIFICATION=${ASK_TERMINAL_USE_CLARIFICATION:-true}  # ask for clarification when refusing a command
 ASK_TERMINAL_COMMAND_HISTORY=${ASK_TERMINAL_COMMAND_HISTORY:-true}   # add commands to the shell history
 ASK_TERMINAL_REFUSED_COMMAND_HISTORY=${ASK_TERMINAL_REFUSED_COMMAND_HISTORY:-true}   # add commands to the shell history even if it gets refused
+ASK_TERMINAL_USE_WEBSOCKET=${ASK_TERMINAL_USE_WEBSOCKET:-false}  # run a helper (ask-terminal-client.py) in the background for the shell session, which keeps a WebSocket connection to the server and does the JSON encoding and decoding, instead of running curl, jq and python3 for every request
 
 # internal variables
 
 _MESSAGE_PREFIX="%"
 _conversation_id=
+_helper_pid=
+_helper_dir=
+_helper_server_url=
+_helper_server_socket=
+_helper_request_id=0
+_colors_cached=false
+
+if [[ -n $BASH_VERSION ]]; then
+  _SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+elif [[ -n $ZSH_VERSION ]]; then
+  _SCRIPT_DIR="$(cd "$(dirname "${(%):-%x}")" && pwd)"
+else
+  _SCRIPT_DIR="$HOME/.ask-terminal"
+fi
 
 # constant
 
 SIGNAL_OFFSET=128
 SIGINT_EXITCODE=$(( $SIGNAL_OFFSET + $(kill -l SIGINT) ))
+_COLOR_NAMES="black red green yellow blue magenta cyan gray lightgray lightred lightgreen lightyellow lightblue lightmagenta lightcyan white reset"
 
 
 # handy functions
@@ -181,7 +198,7 @@ _json_dumps() {
   python3 -c "import sys, json; print(json.dumps(sys.stdin.read()))"
 }
 
-color() {
+_tput_color() {
   case $1 in
     black) tput setaf 0 ;;      # Black
     red) tput setaf 1 ;;        # Red
@@ -204,6 +221,37 @@ color() {
   esac
 }
 
+_cache_colors() {
+  # run tput once per color for the session instead of for every message
+  local name
+
+  if $_colors_cached; then
+    return
+  fi
+  for name in $_COLOR_NAMES; do
+    eval "_color_${name}=\"\$(_tput_color ${name})\""
+  done
+  _colors_cached=true
+}
+
+color() {
+  local name=$1
+
+  if ! $_colors_cached; then
+    _tput_color "$name"
+    return $?
+  fi
+
+  case $name in
+    grey) name=gray ;;
+    lightgrey) name=lightgray ;;
+  esac
+  case " $_COLOR_NAMES " in
+    *" $name "*) eval "printf '%s' \"\${_color_${name}}\"" ;;
+    *) return 1 ;;
+  esac
+}
+
 _print_message() {
   local message=$1
   local detail=$2
@@ -225,6 +273,14 @@ _print_section_prompt() {
 
 # APIs
 
+_curl() {
+  if [[ -n "$ASK_TERMINAL_SERVER_SOCKET" ]]; then
+    curl --unix-socket "$ASK_TERMINAL_SERVER_SOCKET" "$@"
+  else
+    curl "$@"
+  fi
+}
+
 _curl_server() {
   local url="$1"
   local data="$2"
@@ -239,7 +295,7 @@ _curl_server() {
     data_source="@""$data_memfile"
   fi
 
-  curl -s --no-buffer \
+  _curl -s --no-buffer \
     -X POST "${ASK_TERMINAL_SERVER_URL}${url}" \
     -H "Content-Type: application/json" \
     -d "$data_source"
@@ -252,8 +308,123 @@ _curl_server() {
   return $ret_code
 }
 
+_start_helper() {
+  local shell_name="$(ps -p $$ -o comm=)"
+
+  _helper_dir="$(mktemp -d /tmp/ask-terminal-helper-XXXXXX)"
+  mkfifo "$_helper_dir/requests" "$_helper_dir/responses"
+
+  if [[ -n $BASH_VERSION ]]; then
+    { python3 "$_SCRIPT_DIR/ask-terminal-client.py" --shell "$shell_name" --unix-socket "$ASK_TERMINAL_SERVER_SOCKET" "$ASK_TERMINAL_SERVER_URL" \
+      <"$_helper_dir/requests" >"$_helper_dir/responses" & } 2>/dev/null
+    _helper_pid=$!
+    disown $_helper_pid
+  elif [[ -n $ZSH_VERSION ]]; then
+    python3 "$_SCRIPT_DIR/ask-terminal-client.py" --shell "$shell_name" --unix-socket "$ASK_TERMINAL_SERVER_SOCKET" "$ASK_TERMINAL_SERVER_URL" \
+      <"$_helper_dir/requests" >"$_helper_dir/responses" &!
+    _helper_pid=$!
+  else
+    python3 "$_SCRIPT_DIR/ask-terminal-client.py" --shell "$shell_name" --unix-socket "$ASK_TERMINAL_SERVER_SOCKET" "$ASK_TERMINAL_SERVER_URL" \
+      <"$_helper_dir/requests" >"$_helper_dir/responses" &
+    _helper_pid=$!
+  fi
+
+  # in this order, so that opening each fifo meets the other end opened by the helper
+  exec 7>"$_helper_dir/requests"
+  exec 8<"$_helper_dir/responses"
+  _helper_server_url=$ASK_TERMINAL_SERVER_URL
+  _helper_server_socket=$ASK_TERMINAL_SERVER_SOCKET
+}
+
+_stop_helper() {
+  if [[ -n $_helper_pid ]]; then
+    exec 7>&- 8<&-  # the helper exits at the end of its input
+    rm -rf "$_helper_dir"
+    _helper_pid=
+    _helper_dir=
+    _helper_server_url=
+    _helper_server_socket=
+  fi
+}
+
+_prepare_helper_request() {
+  # to be called in the current shell before each request, since requests are made in subshells
+  if ! $ASK_TERMINAL_USE_WEBSOCKET; then
+    return
+  fi
+
+  if [[ -z $_helper_pid || "$_helper_server_url" != "$ASK_TERMINAL_SERVER_URL" || "$_helper_server_socket" != "$ASK_TERMINAL_SERVER_SOCKET" ]] || ! kill -0 $_helper_pid 2>/dev/null; then
+    _stop_helper
+    _start_helper
+  fi
+  _helper_request_id=$(( _helper_request_id + 1 ))
+}
+
+_cancel_helper_request() {
+  if $ASK_TERMINAL_USE_WEBSOCKET && [[ -n $_helper_pid ]]; then
+    printf '%s\0' cancel '' >&7
+  fi
+}
+
+_helper_request() {
+  local request_type="$1"; shift
+  local request_id=$_helper_request_id
+  local line
+  local ended=false
+
+  # fields are raw text ended by NUL, see ask-terminal-client.py
+  printf '%s\0' "$request_type" "id=${request_id}" "conversation_id=${_conversation_id}" "$@" '' >&7
+
+  # skip what is left of the responses to the requests cancelled before
+  while IFS= read -r line <&8; do
+    if [[ "$line" == "%begin ${request_id}" ]]; then
+      break
+    fi
+  done
+  while IFS= read -r line <&8; do
+    if [[ "$line" == "%end ${request_id}" ]]; then
+      ended=true
+      break
+    fi
+    echo -E "$line"
+  done
+
+  if ! $ended; then
+    return 1  # the helper has exited
+  fi
+}
+
+_request_server() {
+  local url="$1"
+  local data="$2"
+  local observation_file="$3"
+
+  if [[ -n "$observation_file" ]]; then
+    _query_reply_raw "$data" "$observation_file"
+  else
+    _curl_server "$url" "$data"
+  fi
+}
+
+_delete_conversation() {
+  if $ASK_TERMINAL_USE_WEBSOCKET; then
+    _helper_request delete
+    return $?
+  fi
+
+  _curl -s -X DELETE "${ASK_TERMINAL_SERVER_URL}/chat/${_conversation_id}"
+}
+
 _init_conversation() {
   local data="{"
+
+  if $ASK_TERMINAL_USE_WEBSOCKET; then
+    _helper_request init \
+      ${ASK_TERMINAL_ENDPOINT:+"endpoint=$ASK_TERMINAL_ENDPOINT"} \
+      ${ASK_TERMINAL_MODEL:+"model_name=$ASK_TERMINAL_MODEL"}
+    return $?
+  fi
+
   if [[ -n "$ASK_TERMINAL_ENDPOINT" ]]; then
     data+="\"endpoint\": \"$ASK_TERMINAL_ENDPOINT\","
   fi
@@ -265,13 +436,18 @@ _init_conversation() {
   fi
   data+="}"
 
-  _curl_server "/chat/${_conversation_id}/init" "$data"
+  _request_server "/chat/${_conversation_id}/init" "$data"
 }
 
 _query_command() {
   local query="$1"
   local data
 
+  if $ASK_TERMINAL_USE_WEBSOCKET; then
+    _helper_request query_command "message=$query" "stream=$ASK_TERMINAL_USE_STREAMING"
+    return $?
+  fi
+
   query=$(echo -ne "$query" | _json_dumps)
 
   data="{ \
@@ -280,28 +456,59 @@ _query_command() {
     \"env\": $(_get_env)
   }"
 
-  _curl_server "/chat/${_conversation_id}/query_command" "$data"
+  _request_server "/chat/${_conversation_id}/query_command" "$data"
   return $?
 }
 
 _query_reply() {
   local executed="$1"
   local observation="$2"
+  local observation_file="$3"
+  local message_field=
   local data
 
-  observation=$(echo -ne "$observation" | _json_dumps)
+  if $ASK_TERMINAL_USE_WEBSOCKET; then
+    if [[ -n "$observation_file" ]]; then
+      _helper_request query_reply "command_executed=$executed" "stream=$ASK_TERMINAL_USE_STREAMING" "observation_file=$observation_file"
+    else
+      _helper_request query_reply "command_executed=$executed" "stream=$ASK_TERMINAL_USE_STREAMING" "message=$observation"
+    fi
+    return $?
+  fi
+
+  if [[ -z "$observation_file" ]]; then
+    observation=$(echo -ne "$observation" | _json_dumps)
+    message_field="\"message\": $observation,"
+  fi  # otherwise the file is uploaded as is
 
   data="{ \
     \"command_executed\": $executed, \
-    \"message\": $observation, \
+    $message_field \
     \"stream\": $ASK_TERMINAL_USE_STREAMING, \
     \"env\": $(_get_env)
   }"
 
-  _curl_server "/chat/${_conversation_id}/query_reply" "$data"
+  _request_server "/chat/${_conversation_id}/query_reply" "$data" "$observation_file"
   return $?
 }
 
+_query_reply_raw() {
+  local data="$1"
+  local observation_file="$2"
+  local params
+
+  # the fields of the request go to the query string, the output to the body
+  params=$(echo -E "$data" | jq -r '"command_executed=\(.command_executed)&stream=\(.stream)&os=\(.env.os | @uri)&shell=\(.env.shell | @uri)"')
+
+  # upload the output as is, the server only keeps its beginning and its end;
+  # streamed from the file (-T), unlike --data-binary which reads it in memory first
+  _curl -s --no-buffer \
+    -X POST "${ASK_TERMINAL_SERVER_URL}/chat/${_conversation_id}/query_reply_raw?${params}" \
+    -H "Content-Type: application/octet-stream" \
+    -H "Expect:" \
+    -T "${observation_file}"
+}
+
 # core functions
 
 _parse_error_from_result() {
@@ -322,6 +529,16 @@ _parse_error_from_result() {
   echo "$error"
 }
 
+_reset_if_conversation_expired() {
+  local error="$1"
+
+  if [[ "$error" == "Conversation does not exist" ]]; then
+    # evicted by the server, start a new conversation next time
+    _conversation_id=
+    _print_message "The conversation has expired. A new one will be started next time." "" grey
+  fi
+}
+
 _confirm_command_execution() {
   local choice=
 
@@ -360,6 +577,7 @@ _process_response_stream() {
 
   local first_error_result=
   local error=null
+  local kind=
   local section=
   local finished=
   local content=
@@ -374,15 +592,26 @@ _process_response_stream() {
       continue
     fi
 
-    error=$(echo -E "$line" | jq '.error')  # could be null, keep the string quoted
-    section=$(echo -E "$line" | jq -r '.section')
-    finished=$(echo -E "$line" | jq -r '.finished')
-    IFS= read -rd '' content < <(echo -E "$line" | jq -r '.content')  # workaround for subshell trailing newlines trimming issue
-    content=${content%$'\n'}
+    if [[ "$line" == "%frame"$'\x1f'* || "$line" == "%result"$'\x1f'* ]]; then
+      # already decoded by the helper, see ask-terminal-client.py
+      IFS=$'\x1f' read -r kind error section finished content <<<"$line"
+      content=${content//$'\x1e'/$'\n'}
+    else
+      kind=
+      error=$(echo -E "$line" | jq '.error')  # could be null, keep the string quoted
+      section=$(echo -E "$line" | jq -r '.section')
+      finished=$(echo -E "$line" | jq -r '.finished')
+      IFS= read -rd '' content < <(echo -E "$line" | jq -r '.content')  # workaround for subshell trailing newlines trimming issue
+      content=${content%$'\n'}
+    fi
 
     if [[ "$error" != null ]]; then
       if [[ -z "$first_error_result" ]]; then
-        first_error_result="$line"
+        if [[ "$kind" == "%result" ]]; then
+          first_error_result="$content"  # the response as JSON
+        else
+          first_error_result="$line"
+        fi
       fi
 
       continue  # consume the reminding streams
@@ -457,17 +686,20 @@ _chat_once() {
   local reply
   local exec_command
   local observation
+  local observation_file
   local line
   local end_result
   local ret_code
   local error
 
   if ! $ASK_TERMINAL_USE_STREAMING; then
+    _prepare_helper_request
     result=$(_query_command "$query")
     _status=$(echo -E "$result" | jq -r ".status")
     if [[ $_status != "success" ]]; then
       error=$(_parse_error_from_result "$result")
       _print_message "Failed to generate command:" "$error" red
+      _reset_if_conversation_expired "$error"
       return 1
     fi
 
@@ -480,6 +712,7 @@ _chat_once() {
   else
     trap "echo" SIGINT
 
+    _prepare_helper_request
     exec 3>&1
     end_result=$(
       _query_command "$query" | \
@@ -493,6 +726,7 @@ _chat_once() {
     trap - SIGINT
 
     if [[ $ret_code -eq $SIGINT_EXITCODE ]]; then
+      _cancel_helper_request
       if [[ -n $BASH_VERSION ]] && ( ! _version_gt "$BASH_VERSION" "3.2" ); then
         # manually add a newline for bash 3.2 when interrupted
         echo -ne $'\n'
@@ -509,6 +743,7 @@ _chat_once() {
 
     if [[ -n "$error" ]]; then
       _print_message "Failed to query command:" "${error}" red
+      _reset_if_conversation_expired "$error"
       return 1
     fi
 
@@ -561,9 +796,9 @@ _chat_once() {
     fi
 
     if $ASK_TERMINAL_USE_REPLY; then
-      eval "$_command" 1>$memfile 2>&1
+      eval "$_command" 1>$memfile 2>&1 7>&- 8<&-
     else
-      eval "$_command"
+      eval "$_command" 7>&- 8<&-
     fi
 
     if $ASK_TERMINAL_USE_REPLY; then
@@ -575,8 +810,7 @@ _chat_once() {
       elif [[ -n $ZSH_VERSION ]]; then
         kill $display_job
       fi
-      observation=$(cat $memfile)
-      rm $memfile
+      observation_file=$memfile  # uploaded as is, then removed
 
       trap - SIGINT
     fi
@@ -593,7 +827,11 @@ _chat_once() {
     fi
 
     if ! $ASK_TERMINAL_USE_STREAMING; then
-      result=$(_query_reply "$exec_command" "$observation")
+      _prepare_helper_request
+      result=$(_query_reply "$exec_command" "$observation" "$observation_file")
+      if [[ -n $observation_file ]]; then
+        rm $observation_file
+      fi
       _status=$(echo -E "$result" | jq -r ".status")
       if [[ $_status != "success" ]]; then
         error=$(_parse_error_from_result "$result")
@@ -606,18 +844,23 @@ _chat_once() {
     else
       trap "echo" SIGINT
 
+      _prepare_helper_request
       exec 3>&1
       end_result=$(
-        _query_reply "$exec_command" "$observation" | \
+        _query_reply "$exec_command" "$observation" "$observation_file" | \
           _process_response_stream "Reply" 'reply' reply; \
           _get_exec_status "${PIPESTATUS[@]}${pipestatus[@]}"
       )
       ret_code=$?
       exec 3>&-
+      if [[ -n $observation_file ]]; then
+        rm $observation_file
+      fi
 
       trap - SIGINT
 
       if [[ $ret_code -eq $SIGINT_EXITCODE ]]; then
+        _cancel_helper_request
         if [[ -n $BASH_VERSION ]] && ( ! _version_gt "$BASH_VERSION" "3.2" ); then
           # manually add a newline for bash 3.2 when interrupted
           echo -ne $'\n'
@@ -644,6 +887,7 @@ _chat_once() {
 
 _check_env_vars() {
   _ensure_bool ASK_TERMINAL_USE_BLACKLIST false
+  _ensure_bool ASK_TERMINAL_USE_WEBSOCKET false
   _ensure_bool ASK_TERMINAL_USE_REPLY true
   _ensure_bool ASK_TERMINAL_USE_STREAMING true
   _ensure_bool ASK_TERMINAL_USE_CLARIFICATION true
@@ -651,6 +895,11 @@ _check_env_vars() {
 }
 
 ask-terminal-reset() {
+  if [[ -n "$_conversation_id" ]]; then
+    _prepare_helper_request
+    ( _delete_conversation ) >/dev/null 2>&1
+  fi
+  _stop_helper
   _conversation_id=
 }
 
@@ -662,6 +911,7 @@ ask-terminal() {
   local ret_code
 
   _check_env_vars
+  _cache_colors
 
   if [[ -z "$_conversation_id" ]]; then
     if [[ -n "$ASK_TERMINAL_ENDPOINT" ]]; then
@@ -670,6 +920,7 @@ ask-terminal() {
 
     # generate a UUID as conversation ID
     _conversation_id=$(uuidgen)
+    _prepare_helper_request
     result=$(_init_conversation)
     _status=$(echo -E "$result" | jq -r ".status")
     if [[ $_status != "success" ]]; then